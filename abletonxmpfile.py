@@ -2,48 +2,107 @@ from lxml import etree
 from datetime import datetime
 from xml.sax.saxutils import quoteattr, escape
 import os
+import re
+import stat
+import tempfile
+from io import BytesIO
+
+RDF_NS = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+ABLFR_NS = "https://ns.ableton.com/xmp/fs-resources/1.0/"
+
+RDF_LI = f"{{{RDF_NS}}}li"
+RDF_BAG = f"{{{RDF_NS}}}Bag"
+ABLFR_FILEPATH = f"{{{ABLFR_NS}}}filePath"
+ABLFR_KEYWORDS = f"{{{ABLFR_NS}}}keywords"
+RDF_PARSETYPE = f"{{{RDF_NS}}}parseType"
+XMP_METADATADATE = "{http://ns.adobe.com/xap/1.0/}MetadataDate"
+METADATA_DATE_RE = re.compile(
+    r"<([\w.-]+:)?MetadataDate>[^<]*</([\w.-]+:)?MetadataDate>"
+)
+
+# Elements that are streamed through rather than buffered, down to the bag
+# holding one rdf:li per file
+STREAMED_CONTAINERS = (
+    "{adobe:ns:meta/}xmpmeta",
+    f"{{{RDF_NS}}}RDF",
+    f"{{{RDF_NS}}}Description",
+    f"{{{ABLFR_NS}}}items",
+    RDF_BAG,
+)
+
+
+def new_xmp_template():
+    current_datetime = datetime.now().strftime("%Y-%m-%dT%H:%M:%S%z")
+    return f"""
+        <x:xmpmeta xmlns:x="adobe:ns:meta/" x:xmptk="XMP Core 5.6.0">
+        <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+            <rdf:Description rdf:about=""
+                    xmlns:dc="http://purl.org/dc/elements/1.1/"
+                    xmlns:ablFR="https://ns.ableton.com/xmp/fs-resources/1.0/"
+                    xmlns:xmp="http://ns.adobe.com/xap/1.0/">
+                <dc:format>application/vnd.ableton.folder</dc:format>
+                <ablFR:resource>folder</ablFR:resource>
+                <ablFR:platform>mac</ablFR:platform>
+                <ablFR:items>
+                    <rdf:Bag>
+                    
+                    </rdf:Bag>
+                </ablFR:items>
+                <xmp:CreatorTool>Updated by Ableton Index 12.0</xmp:CreatorTool>
+                <xmp:CreateDate>{current_datetime}</xmp:CreateDate>
+                <xmp:MetadataDate>{current_datetime}</xmp:MetadataDate>
+            </rdf:Description>
+        </rdf:RDF>
+        </x:xmpmeta>
+        """
 
 
 class AbletonXMPFile:
-    def __init__(self, file_path=None):
+    # content, when given, is the sidecar as read by read_sidecar() ahead of
+    # time, so building the object doesn't block on storage
+    def __init__(self, file_path=None, content=None):
         self.file_path = file_path
         self.is_changed = False
         self.nsmap = {
-            "ablFR": "https://ns.ableton.com/xmp/fs-resources/1.0/",
-            "rdf": "http://www.w3.org/1999/02/22-rdf-syntax-ns#",
+            "ablFR": ABLFR_NS,
+            "rdf": RDF_NS,
         }
         self.parser = etree.XMLParser(remove_blank_text=True)
-        try:
-            with open(file_path, "r", encoding="utf-8") as file:
-                self.root = etree.parse(file, self.parser).getroot()
-        except FileNotFoundError:
-            current_datetime = datetime.now().strftime("%Y-%m-%dT%H:%M:%S%z")
-            template = f"""
-                <x:xmpmeta xmlns:x="adobe:ns:meta/" x:xmptk="XMP Core 5.6.0">
-                <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
-                    <rdf:Description rdf:about=""
-                            xmlns:dc="http://purl.org/dc/elements/1.1/"
-                            xmlns:ablFR="https://ns.ableton.com/xmp/fs-resources/1.0/"
-                            xmlns:xmp="http://ns.adobe.com/xap/1.0/">
-                        <dc:format>application/vnd.ableton.folder</dc:format>
-                        <ablFR:resource>folder</ablFR:resource>
-                        <ablFR:platform>mac</ablFR:platform>
-                        <ablFR:items>
-                            <rdf:Bag>
-                            
-                            </rdf:Bag>
-                        </ablFR:items>
-                        <xmp:CreatorTool>Updated by Ableton Index 12.0</xmp:CreatorTool>
-                        <xmp:CreateDate>{current_datetime}</xmp:CreateDate>
-                        <xmp:MetadataDate>{current_datetime}</xmp:MetadataDate>
-                    </rdf:Description>
-                </rdf:RDF>
-                </x:xmpmeta>
-                """
+        if content is None:
+            content = read_sidecar(file_path)
+        if content:
+            self.root = etree.parse(BytesIO(content), self.parser).getroot()
+        else:
+            template = new_xmp_template()
             self.root = etree.XML(template, self.parser)
 
-    def add_tag(self, file_path, keyword):
-        added = False
+        self._build_index()
+
+    def _build_index(self):
+        # filePath -> (item, keywords bag, set of keywords), built once so
+        # that lookups and inserts don't have to scan the whole document
+        self.items_bag = self.root.xpath(
+            "//ablFR:items/rdf:Bag",
+            namespaces=self.nsmap,
+        )[0]
+        self._items = {}
+        for item in self.items_bag.iterchildren(RDF_LI):
+            file_path = item.findtext(ABLFR_FILEPATH)
+            if file_path is None or file_path in self._items:
+                continue
+            keywords_bag = item.find(f"{ABLFR_KEYWORDS}/{RDF_BAG}")
+            keywords = (
+                set(keyword.text for keyword in keywords_bag.iterchildren(RDF_LI))
+                if keywords_bag is not None
+                else set()
+            )
+            self._items[file_path] = [item, keywords_bag, keywords]
+
+    def _get_item(self, file_path):
+        entry = self._items.get(file_path)
+        if entry is not None:
+            return entry, False
+
         item_template = f"""
         <rdf:li rdf:parseType="Resource" 
                 xmlns:ablFR="https://ns.ableton.com/xmp/fs-resources/1.0/"
@@ -55,50 +114,64 @@ class AbletonXMPFile:
             </ablFR:keywords>
         </rdf:li>
         """
+        item = etree.XML(item_template, self.parser)
+        self.items_bag.append(item)
+        entry = [item, item.find(f"{ABLFR_KEYWORDS}/{RDF_BAG}"), set()]
+        self._items[file_path] = entry
+        return entry, True
 
-        items = self.root.xpath(
-            f"//ablFR:items/rdf:Bag/rdf:li",
-            namespaces=self.nsmap,
-        )
-        # collect existing filepaths
-        existing_filepaths = [
-            item.xpath("ablFR:filePath", namespaces=self.nsmap)[0].text
-            for item in items
-        ]
-        # check if the file path already exists
-        if file_path in existing_filepaths:
-            item = items[existing_filepaths.index(file_path)]
-        else:
-            item = etree.XML(item_template, self.parser)
-            self.root.xpath(
-                "//ablFR:items/rdf:Bag",
-                namespaces=self.nsmap,
-            )[
-                0
-            ].append(item)
-            added = True
-
-        existing_keywords = item.xpath(
-            "ablFR:keywords/rdf:Bag/rdf:li",
-            namespaces=self.nsmap,
-        )
-        existing_keyword_values = [keyword.text for keyword in existing_keywords]
-        if keyword not in existing_keyword_values:
-            keywords_bag = item.xpath(
-                "ablFR:keywords/rdf:Bag",
-                namespaces=self.nsmap,
-            )[0]
-            new_keyword = etree.SubElement(
-                keywords_bag, "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}li"
-            )
+    def has_item(self, file_path):
+        return file_path in self._items
+
+    def get_keywords(self, file_path):
+        entry = self._items.get(file_path)
+        return frozenset(entry[2]) if entry is not None else frozenset()
+
+    # Adds all keywords for a file in one go, returns the ones that were new
+    def add_tags(self, file_path, keywords):
+        (item, keywords_bag, existing_keywords), added_item = self._get_item(file_path)
+        added = []
+        for keyword in keywords:
+            if keyword in existing_keywords:
+                continue
+            if keywords_bag is None:
+                keywords_bag = etree.SubElement(
+                    etree.SubElement(item, ABLFR_KEYWORDS), RDF_BAG
+                )
+                self._items[file_path][1] = keywords_bag
+            new_keyword = etree.SubElement(keywords_bag, RDF_LI)
             new_keyword.text = keyword
-            added = True
+            existing_keywords.add(keyword)
+            added.append(keyword)
 
-        if added:
+        if added or added_item:
             self.is_changed = True
 
         return added
 
+    # Removes keywords from a file, returns the ones that were there
+    def remove_tags(self, file_path, keywords):
+        entry = self._items.get(file_path)
+        if entry is None:
+            return []
+        _, keywords_bag, existing_keywords = entry
+        keywords = set(keywords) & existing_keywords
+        if not keywords:
+            return []
+
+        removed = []
+        for keyword in list(keywords_bag.iterchildren(RDF_LI)):
+            if keyword.text in keywords:
+                keywords_bag.remove(keyword)
+                existing_keywords.discard(keyword.text)
+                removed.append(keyword.text)
+        self.is_changed = True
+        return removed
+
+    def add_tag(self, file_path, keyword):
+        added_item = file_path not in self._items
+        return bool(self.add_tags(file_path, (keyword,))) or added_item
+
     def dump(self):
         metadata_date = self.root.xpath(
             "//xmp:MetadataDate",
@@ -120,17 +193,264 @@ class AbletonXMPFile:
 
     def save_if_changed(self, file_path=None):
         if not self.is_changed:
-            return
+            return False
 
         if not file_path:
             file_path = self.file_path
 
-        xml = self.dump()
+        written = write_if_different(file_path, self.dump())
+        self.is_changed = False
+        return written
+
+
+def _without_metadata_date(xml):
+    return METADATA_DATE_RE.sub("", xml)
+
+
+# Read once, changing the umask isn't thread safe
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def copy_file_mode(temp_path, file_path):
+    # NamedTemporaryFile creates files as 0600 and os.replace keeps that, so
+    # the temp file gets the mode of the file it replaces, or the one a plain
+    # open() would have given a new file
+    try:
+        mode = stat.S_IMODE(os.stat(file_path).st_mode)
+    except FileNotFoundError:
+        mode = 0o666 & ~_UMASK
+    os.chmod(temp_path, mode)
 
+
+def _replace_atomic(temp_file, file_path):
+    # Makes sure the new content is on disk before it takes the place of the
+    # old file, so a crash leaves either the old or the new file behind
+    temp_file.flush()
+    os.fsync(temp_file.fileno())
+    temp_file.close()
+    copy_file_mode(temp_file.name, file_path)
+    os.replace(temp_file.name, file_path)
+
+
+def write_atomic(file_path, xml):
+    folder_path = os.path.dirname(file_path)
+    os.makedirs(folder_path, exist_ok=True)  # Ensure the folder exists
+
+    temp_file = tempfile.NamedTemporaryFile(
+        "w", encoding="utf-8", dir=folder_path, prefix=".", suffix=".tmp", delete=False
+    )
+    try:
+        temp_file.write(xml)
+        _replace_atomic(temp_file, file_path)
+    except BaseException:
+        temp_file.close()
+        os.unlink(temp_file.name)
+        raise
+
+
+def write_if_different(file_path, xml, content=None):
+    # Skips the write when only the MetadataDate would change, so Live doesn't
+    # re-index sidecars whose content is the same. content saves reading the
+    # file again when the caller already has it from read_sidecar().
+    if content is None:
+        content = read_sidecar(file_path)
+    current_xml = decode_sidecar(content)
+
+    if current_xml:
+        if _without_metadata_date(current_xml) == _without_metadata_date(xml):
+            return False
+
+    write_atomic(file_path, xml)
+    return True
+
+
+def read_sidecar(file_path):
+    # The raw bytes of a sidecar, b"" if it doesn't exist yet
+    try:
+        with open(file_path, "rb") as file:
+            return file.read()
+    except FileNotFoundError:
+        return b""
+
+
+def decode_sidecar(content):
+    # Text of a sidecar with universal newlines, like reading it in text mode
+    return content.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+
+
+def read_keywords(file_path, content=None):
+    # Reads {file path: keywords} from a sidecar without building the tree or
+    # keeping more than one item in memory. A missing file has no keywords.
+    keywords = {}
+    if content is not None:
+        if not content:
+            return keywords
+        source = BytesIO(content)
+    else:
+        try:
+            source = open(file_path, "rb")
+        except FileNotFoundError:
+            return keywords
+
+    with source:
+        for _, elem in etree.iterparse(source, events=("end",), tag=RDF_LI):
+            name = elem.findtext(ABLFR_FILEPATH)
+            if name is None:
+                # A keyword of an item that hasn't ended yet
+                continue
+            keywords.setdefault(name, set()).update(
+                keyword.text
+                for keyword in elem.iterfind(f"{ABLFR_KEYWORDS}/{RDF_BAG}/{RDF_LI}")
+            )
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+    return keywords
+
+
+class _NullWriter:
+    def write(self, data):
+        pass
+
+
+def _write_element(xf, elem, level):
+    # Writes a buffered element through the incremental writer so namespaces
+    # declared by the enclosing streamed elements are not repeated
+    with xf.element(elem.tag, dict(elem.attrib)):
+        if elem.text and elem.text.strip():
+            xf.write(elem.text)
+        children = [child for child in elem if isinstance(child.tag, str)]
+        for child in children:
+            xf.write("\n" + "  " * (level + 1))
+            _write_element(xf, child, level + 1)
+        if children:
+            xf.write("\n" + "  " * level)
+
+
+def _merge_item(item, tags):
+    # Adds the keywords that are missing from a parsed rdf:li item
+    keywords_bag = item.find(f"{ABLFR_KEYWORDS}/{RDF_BAG}")
+    if keywords_bag is None:
+        keywords_bag = etree.SubElement(etree.SubElement(item, ABLFR_KEYWORDS), RDF_BAG)
+    existing_keywords = set(
+        keyword.text for keyword in keywords_bag.iterchildren(RDF_LI)
+    )
+    added = []
+    for tag in tags:
+        if tag not in existing_keywords:
+            etree.SubElement(keywords_bag, RDF_LI).text = tag
+            existing_keywords.add(tag)
+            added.append(tag)
+    return added
+
+
+def stream_add_tags(file_path, file_tags, dry_run=False):
+    # Streaming counterpart of AbletonXMPFile.add_tags + save_if_changed for
+    # very large sidecars: items are merged as they are parsed and written out
+    # one by one, so neither the full tree nor the full output is held in
+    # memory. Returns the (file name, tag) pairs that were added.
+    pending = {}
+    for name, tags in file_tags:
+        pending.setdefault(name, []).extend(tags)
+
+    added = []
+    changed = False
+    if os.path.exists(file_path):
+        source = open(file_path, "rb")
+    else:
+        source = BytesIO(new_xmp_template().encode("utf-8"))
+
+    if dry_run:
+        output = _NullWriter()
+    else:
         folder_path = os.path.dirname(file_path)
         os.makedirs(folder_path, exist_ok=True)  # Ensure the folder exists
+        output = tempfile.NamedTemporaryFile(
+            dir=folder_path, prefix=".", suffix=".tmp", delete=False
+        )
 
-        with open(file_path, "w", encoding="utf-8") as file:
-            file.write(xml)
+    try:
+        with source, etree.xmlfile(output, encoding="utf-8") as xf:
+            contexts = []
+            depth = 0
+            metadata_date_seen = False
+            for event, elem in etree.iterparse(
+                source, events=("start", "end"), remove_blank_text=True
+            ):
+                streamed = len(contexts)
+                if event == "start":
+                    depth += 1
+                    if (
+                        depth == streamed + 1
+                        and streamed < len(STREAMED_CONTAINERS)
+                        and elem.tag == STREAMED_CONTAINERS[streamed]
+                    ):
+                        parent = elem.getparent()
+                        parent_nsmap = parent.nsmap if parent is not None else {}
+                        nsmap = {
+                            prefix: uri
+                            for prefix, uri in elem.nsmap.items()
+                            if parent_nsmap.get(prefix) != uri
+                        }
+                        if contexts:
+                            xf.write("\n" + "  " * streamed)
+                        context = xf.element(elem.tag, dict(elem.attrib), nsmap=nsmap)
+                        context.__enter__()
+                        contexts.append(context)
+                    continue
 
-        self.is_changed = False
+                if depth == streamed and contexts:
+                    # Closing a streamed container
+                    if elem.tag == RDF_BAG:
+                        for name, tags in pending.items():
+                            item = etree.Element(RDF_LI, {RDF_PARSETYPE: "Resource"})
+                            etree.SubElement(item, ABLFR_FILEPATH).text = name
+                            new_tags = _merge_item(item, tags)
+                            added.extend((name, tag) for tag in new_tags)
+                            changed = True
+                            xf.write("\n" + "  " * depth)
+                            _write_element(xf, item, depth)
+                        pending = {}
+                    elif elem.tag == STREAMED_CONTAINERS[2] and not metadata_date_seen:
+                        metadata_date = etree.Element(XMP_METADATADATE)
+                        metadata_date.text = datetime.now().strftime(
+                            "%Y-%m-%dT%H:%M:%S%z"
+                        )
+                        xf.write("\n" + "  " * depth)
+                        _write_element(xf, metadata_date, depth)
+                    xf.write("\n" + "  " * (depth - 1))
+                    contexts.pop().__exit__(None, None, None)
+                elif depth == streamed + 1:
+                    # A complete child of a streamed container
+                    if streamed == len(STREAMED_CONTAINERS) and elem.tag == RDF_LI:
+                        name = elem.findtext(ABLFR_FILEPATH)
+                        tags = pending.pop(name, None)
+                        if tags:
+                            new_tags = _merge_item(elem, tags)
+                            added.extend((name, tag) for tag in new_tags)
+                            changed = changed or bool(new_tags)
+                    elif elem.tag == XMP_METADATADATE:
+                        metadata_date_seen = True
+                        elem.text = datetime.now().strftime("%Y-%m-%dT%H:%M:%S%z")
+                    xf.write("\n" + "  " * (depth - 1))
+                    _write_element(xf, elem, depth - 1)
+                    # Release everything parsed so far
+                    elem.clear()
+                    while elem.getprevious() is not None:
+                        del elem.getparent()[0]
+                depth -= 1
+    except BaseException:
+        if not dry_run:
+            output.close()
+            os.unlink(output.name)
+        raise
+
+    if not dry_run:
+        if changed:
+            _replace_atomic(output, file_path)
+        else:
+            output.close()
+            os.unlink(output.name)
+
+    return added
@@ -0,0 +1,78 @@
+import os
+import pathlib
+import sqlite3
+
+# Lets SQLite read the database through the page cache instead of copying
+# every page into its own buffers
+MMAP_SIZE = 256 * 1024 * 1024
+CACHE_SIZE_KIB = 64 * 1024
+# Large enough to keep every statement the importer prepares
+CACHED_STATEMENTS = 256
+
+
+def connect_readonly(
+    db_path, immutable=False, mmap_size=MMAP_SIZE, cache_size_kib=CACHE_SIZE_KIB
+):
+    # Opens the ADSR database read-only so we never take a write lock while the
+    # Sample Manager is running. immutable skips locking and change detection
+    # altogether and is only safe on a copy nobody else writes to.
+    uri = pathlib.Path(db_path).resolve().as_uri() + "?mode=ro"
+    if immutable:
+        uri += "&immutable=1"
+    conn = sqlite3.connect(
+        uri,
+        uri=True,
+        check_same_thread=False,
+        cached_statements=CACHED_STATEMENTS,
+    )
+    conn.execute(f"PRAGMA mmap_size = {int(mmap_size)};")
+    conn.execute(f"PRAGMA cache_size = {-int(cache_size_kib)};")
+    conn.execute("PRAGMA query_only = ON;")
+    return conn
+
+
+# Indexes the importer's queries need. They are only ever created in a
+# snapshot, the Sample Manager's own database is left alone.
+SNAPSHOT_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS tag_importer_folders_path ON folders(path, id);",
+    "CREATE INDEX IF NOT EXISTS tag_importer_files_folder "
+    "ON files(folder_id, id, name, loop);",
+    "CREATE INDEX IF NOT EXISTS tag_importer_file_tags "
+    "ON file_tags(file_id, tag_id);",
+)
+
+
+def folder_range(folder_path, recursive=True):
+    # Bounds for "folder_path or anything below it", "0" being the character
+    # after "/". Unlike a LIKE prefix this doesn't match sibling folders such as
+    # Samples2 when syncing Samples. Not recursive, the range below is empty.
+    folder_path = folder_path.rstrip("/")
+    if not recursive:
+        return folder_path, f"{folder_path}/", f"{folder_path}/"
+    return folder_path, f"{folder_path}/", f"{folder_path}0"
+
+
+def create_indexes(conn):
+    for statement in SNAPSHOT_INDEXES:
+        conn.execute(statement)
+    conn.execute("ANALYZE;")
+    conn.commit()
+
+
+def snapshot(db_path, snapshot_path, indexes=True):
+    # Copies a consistent snapshot of the database with the online backup API,
+    # so the Sample Manager can keep writing while we sync from the copy
+    temp_path = f"{snapshot_path}.tmp"
+    source = connect_readonly(db_path)
+    try:
+        target = sqlite3.connect(temp_path)
+        try:
+            source.backup(target)
+            if indexes:
+                create_indexes(target)
+        finally:
+            target.close()
+    finally:
+        source.close()
+    os.replace(temp_path, snapshot_path)
+    return snapshot_path
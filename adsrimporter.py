@@ -1,8 +1,30 @@
-import sqlite3
-from abletonxmpfile import AbletonXMPFile
+import os
+import time
+import zlib
+from contextlib import contextmanager
+from bisect import bisect_right
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import adsrdb
+from adsrdb import folder_range
+from abletonxmpfile import (
+    AbletonXMPFile,
+    read_keywords,
+    read_sidecar,
+    stream_add_tags,
+    write_if_different,
+)
+from syncmanifest import mapping_version, tags_hash
+from syncstats import SyncStats
+from tagmapping import TagMapping
 
 
 class ADSRImporter:
+    FETCH_SIZE = 1000
+    FOLDERS_IN_FLIGHT_PER_WORKER = 4
+    # Past this many folders, a sync of only some folders reads the whole
+    # prefix once rather than running four queries per folder
+    MAX_FOLDER_QUERIES = 16
     XMP_FILENAME = "dc66a3fa-0fe1-5352-91cf-3ec237e9ee90.xmp"
 
     KEY_MAP = {
@@ -33,89 +55,996 @@ class ADSRImporter:
         36: ("B", "Minor"),
     }
 
-    def __init__(self, db_path, tag_map):
-        self.xmpfilename = "dc66a3fa-0fe1-5352-91cf-3ec237e9ee90.xmp"
-        self.conn = sqlite3.connect(db_path)
-        self.cursor = self.conn.cursor()
-        self.tag_map = tag_map
+    # The statements are fixed strings with bound parameters so sqlite3 keeps
+    # them prepared in its statement cache across folders and syncs
+    TAGS_QUERY = "SELECT id,name,parent_id FROM tags;"
+    # A folder and everything below it, as a range on path that can use an
+    # index on folders(path). LIKE can't, as it is case insensitive.
+    FOLDER_RANGE = "(folders.path = ? OR (folders.path >= ? AND folders.path < ?))"
+    FOLDERS_QUERY = f"""
+        SELECT id,path FROM folders WHERE {FOLDER_RANGE} ORDER BY path;
+        """
+    FILES_QUERY = f"""
+        SELECT files.id,files.folder_id,files.name,files.loop FROM files
+        JOIN folders ON folders.id = files.folder_id
+        WHERE {FOLDER_RANGE};
+        """
+    FILE_TAGS_QUERY = f"""
+        SELECT file_tags.file_id,file_tags.tag_id FROM file_tags
+        JOIN files ON files.id = file_tags.file_id
+        JOIN folders ON folders.id = files.folder_id
+        WHERE {FOLDER_RANGE};
+        """
+    # Not every version of the Sample Manager stores a tempo, the column is
+    # looked up in the schema and the query filled in per connection
+    SAMPLE_META_QUERY = f"""
+        SELECT sample_meta.id,sample_meta.key,{{tempo}} FROM sample_meta
+        JOIN files ON files.id = sample_meta.id
+        JOIN folders ON folders.id = files.folder_id
+        WHERE {FOLDER_RANGE};
+        """
+    TEMPO_COLUMNS = ("tempo", "bpm")
+    TAG_USAGE_QUERY = f"""
+        SELECT file_tags.tag_id,COUNT(DISTINCT file_tags.file_id) FROM file_tags
+        JOIN files ON files.id = file_tags.file_id
+        JOIN folders ON folders.id = files.folder_id
+        WHERE {FOLDER_RANGE} GROUP BY file_tags.tag_id;
+        """
 
-    def _fetch_tag_path(self, tag_id):
-        self.cursor.execute(
-            "SELECT name, parent_id,type FROM tags WHERE id = ?;", (tag_id,)
+    # Cheap per-folder checksums of everything a sync reads, so a watcher can
+    # tell which folders changed without building their tag plans. Every row
+    # is hashed as a whole, so a rename to a name of the same length or a tag
+    # moving between files changes the sum too.
+    FILES_SIGNATURE_QUERY = f"""
+        SELECT folders.path,COUNT(files.id),
+            SUM(tag_importer_row_hash(files.id,files.name,files.loop))
+        FROM folders LEFT JOIN files ON files.folder_id = folders.id
+        WHERE {FOLDER_RANGE} GROUP BY folders.id;
+        """
+    FILE_TAGS_SIGNATURE_QUERY = f"""
+        SELECT folders.path,COUNT(*),
+            SUM(tag_importer_row_hash(file_tags.file_id,file_tags.tag_id))
+        FROM file_tags
+        JOIN files ON files.id = file_tags.file_id
+        JOIN folders ON folders.id = files.folder_id
+        WHERE {FOLDER_RANGE} GROUP BY folders.id;
+        """
+    SAMPLE_META_SIGNATURE_QUERY = f"""
+        SELECT folders.path,
+            SUM(tag_importer_row_hash(sample_meta.id,sample_meta.key,{{tempo}}))
+        FROM sample_meta
+        JOIN files ON files.id = sample_meta.id
+        JOIN folders ON folders.id = files.folder_id
+        WHERE {FOLDER_RANGE} GROUP BY folders.id;
+        """
+
+    # The watcher's checkpoint: row count and highest rowid of every table a
+    # sync reads. Rows appended since are found by rowid, which is cheap, and
+    # their folders are all that changed unless rows were also edited or
+    # deleted.
+    CHECKPOINT_TABLES = ("files", "file_tags", "sample_meta")
+    CHECKPOINT_QUERY = "SELECT COUNT(*),COALESCE(MAX(rowid),0) FROM {table};"
+    APPENDED_COUNT_QUERY = "SELECT COUNT(*) FROM {table} WHERE rowid > ?;"
+    APPENDED_FOLDERS_QUERIES = {
+        "files": f"""
+            SELECT DISTINCT folders.path FROM files
+            JOIN folders ON folders.id = files.folder_id
+            WHERE files.rowid > ? AND {FOLDER_RANGE};
+            """,
+        "file_tags": f"""
+            SELECT DISTINCT folders.path FROM file_tags
+            JOIN files ON files.id = file_tags.file_id
+            JOIN folders ON folders.id = files.folder_id
+            WHERE file_tags.rowid > ? AND {FOLDER_RANGE};
+            """,
+        "sample_meta": f"""
+            SELECT DISTINCT folders.path FROM sample_meta
+            JOIN files ON files.id = sample_meta.id
+            JOIN folders ON folders.id = files.folder_id
+            WHERE sample_meta.rowid > ? AND {FOLDER_RANGE};
+            """,
+    }
+
+    TYPE_TAGS = ("Type|One Shot", "Type|Loop")
+    DEFAULT_TEMPO_EDGES = (90, 110, 130, 150, 170)
+
+    def __init__(
+        self,
+        db_path,
+        tag_map,
+        snapshot_path=None,
+        immutable=False,
+        tempo_edges=DEFAULT_TEMPO_EDGES,
+        tag_paths=None,
+    ):
+        # With snapshot_path the database is copied there first and synced from
+        # the copy, so the Sample Manager never waits on our reads. tempo_edges
+        # are the BPM boundaries of the Tempo| tags, empty to not add any.
+        # tag_paths can be shared with another importer of the same database
+        # so the tag tree is only resolved once.
+        self.db_path = db_path
+        self.snapshot_path = snapshot_path
+        self.immutable = immutable
+        self.tag_map = (
+            tag_map if isinstance(tag_map, TagMapping) else TagMapping(tag_map)
         )
-        tag = self.cursor.fetchone()
-        if tag[1] == -1:
-            return tag[0]
+        self.key_tags = key_tag_table(self.KEY_MAP)
+        self.tempo_edges, self.tempo_tags = tempo_buckets(tempo_edges)
+        self.unknown_keys = Counter()
+        self.sample_meta_query = None
+        self.sample_meta_signature_query = None
+        self.tag_paths = None
+        self.tag_paths_version = None
+        self.tag_targets = {}
+        self.last_stats = None
+        self.last_tags_removed = 0
+        self.conn = None
+        self._connect()
+        if tag_paths is not None:
+            self.tag_paths = tag_paths
+            self.tag_paths_version = self._data_version()
+
+    def _connect(self):
+        if self.snapshot_path is not None:
+            adsrdb.snapshot(self.db_path, self.snapshot_path)
+            self.conn = adsrdb.connect_readonly(self.snapshot_path, immutable=True)
         else:
-            parent_path = self._fetch_tag_path(tag[1])
-            return f"{parent_path}|{tag[0]}"
+            self.conn = adsrdb.connect_readonly(self.db_path, immutable=self.immutable)
+        self.conn.create_function(
+            "tag_importer_row_hash", -1, row_hash, deterministic=True
+        )
 
-    def sync_directory(self, folder_path, dry_run=False, on_tag_added=None):
-        unmapped_tags = set()
-        num_tags_added = 0
+    def refresh_snapshot(self):
+        # Takes a new snapshot so the next sync sees the latest changes
+        if self.snapshot_path is None:
+            return
+        self.close()
+        self.tag_paths = None
+        self.sample_meta_query = None
+        self.sample_meta_signature_query = None
+        self._connect()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def __enter__(self):
+        return self
 
-        self.cursor.execute(
-            "SELECT id,path FROM folders where path LIKE ?;", (f"{folder_path}%",)
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _tempo_column(self):
+        columns = {
+            row[1].lower(): row[1]
+            for row in self.conn.execute("PRAGMA table_info(sample_meta);")
+        }
+        return next(
+            (
+                f'sample_meta."{columns[name]}"'
+                for name in self.TEMPO_COLUMNS
+                if name in columns
+            ),
+            "NULL",
         )
-        items = self.cursor.fetchall()
 
-        for folder in items:
-            print(folder[1])
-            xmp = AbletonXMPFile(f"{folder[1]}/Ableton Folder Info/{self.XMP_FILENAME}")
+    def _sample_meta_query(self):
+        if self.sample_meta_query is None:
+            self.sample_meta_query = self.SAMPLE_META_QUERY.format(
+                tempo=self._tempo_column()
+            )
+        return self.sample_meta_query
+
+    def discover_tags(self, folder_path):
+        # [(tag path, number of samples, destinations)] for every tag in use at
+        # or below folder_path, most used first. Counted by the database in one
+        # query, no sidecar is read. destinations is None for unmapped tags.
+        tag_paths = self.resolve_tag_paths()
+        counts = Counter()
+        for tag_id, samples in self._fetch_rows(
+            self.TAG_USAGE_QUERY, folder_range(folder_path)
+        ):
+            tag_path = tag_paths.get(tag_id)
+            if tag_path is not None:
+                counts[tag_path] += samples
+        return [
+            (tag_path, samples, self.tag_map.lookup(tag_path))
+            for tag_path, samples in sorted(
+                counts.items(), key=lambda item: (-item[1], item[0])
+            )
+        ]
+
+    def folder_paths(self, folder_path):
+        # The folders the database knows at or below folder_path
+        return [
+            path
+            for _, path in self._fetch_rows(
+                self.FOLDERS_QUERY, folder_range(folder_path)
+            )
+        ]
 
-            self.cursor.execute(
-                "SELECT id,name,loop FROM files WHERE folder_id = ?;", (folder[0],)
+    def folder_signatures(self, folder_path, folders=None):
+        # {folder path: checksum} for folder_path and everything below it, or
+        # only for the given folders. Hashes every row, so it costs about as
+        # much as reading the folders.
+        if self.sample_meta_signature_query is None:
+            self.sample_meta_signature_query = self.SAMPLE_META_SIGNATURE_QUERY.format(
+                tempo=self._tempo_column()
             )
-            for file in self.cursor.fetchall():
+        ranges, wanted = self._folder_ranges(folder_path, folders)
+        signatures = {}
+        with self._read_transaction():
+            for bounds in ranges:
+                for query in (
+                    self.FILES_SIGNATURE_QUERY,
+                    self.FILE_TAGS_SIGNATURE_QUERY,
+                    self.sample_meta_signature_query,
+                ):
+                    for path, *checksum in self._fetch_rows(query, bounds):
+                        if wanted is None or path in wanted:
+                            signatures.setdefault(path, []).extend(checksum)
+        return {path: tuple(checksum) for path, checksum in signatures.items()}
+
+    def table_checkpoint(self):
+        # {table: (rows, highest rowid)} for the tables a sync reads
+        with self._read_transaction():
+            return {
+                table: self.conn.execute(
+                    self.CHECKPOINT_QUERY.format(table=table)
+                ).fetchone()
+                for table in self.CHECKPOINT_TABLES
+            }
+
+    def appended_folders(self, folder_path, old_checkpoint, new_checkpoint):
+        # The folders at or below folder_path that rows appended between two
+        # checkpoints belong to. None when appends don't explain the change,
+        # i.e. rows were deleted or edited in place, and only comparing
+        # folder_signatures() can tell which folders changed.
+        if old_checkpoint == new_checkpoint:
+            return None
+        bounds = folder_range(folder_path)
+        folders = set()
+        with self._read_transaction():
+            for table in self.CHECKPOINT_TABLES:
+                rows, max_rowid = old_checkpoint[table]
+                (appended,) = self.conn.execute(
+                    self.APPENDED_COUNT_QUERY.format(table=table), (max_rowid,)
+                ).fetchone()
+                if new_checkpoint[table][0] - rows != appended:
+                    return None
+                if appended:
+                    folders.update(
+                        path
+                        for (path,) in self._fetch_rows(
+                            self.APPENDED_FOLDERS_QUERIES[table], (max_rowid, *bounds)
+                        )
+                    )
+        return folders
+
+    def _data_version(self):
+        # Changes whenever another connection commits to the database
+        return self.conn.execute("PRAGMA data_version;").fetchone()[0]
+
+    def _load_tag_paths(self):
+        # Reads the whole tag hierarchy once and resolves every tag id to its
+        # "Parent|Child" path. Tags that are part of a cycle or hang off a
+        # missing parent resolve to None and are skipped during a sync.
+        tags = {
+            tag_id: (name, parent_id)
+            for tag_id, name, parent_id in self._fetch_rows(self.TAGS_QUERY)
+        }
+        paths = {}
+        for tag_id in tags:
+            chain = []
+            current = tag_id
+            parent_path = None
+            error = None
+            while True:
+                if current in paths:
+                    parent_path = paths[current]
+                    if parent_path is None:
+                        error = f"parent {current} could not be resolved"
+                    break
+                if current in chain:
+                    error = f"cycle through tag {current}"
+                    break
+                tag = tags.get(current)
+                if tag is None:
+                    error = f"missing parent tag {current}"
+                    break
+                chain.append(current)
+                if tag[1] == -1 or tag[1] is None:
+                    break
+                current = tag[1]
+
+            if error is not None:
+                print(f"Skipping tag {tag_id}: {error}")
+                for chain_id in chain:
+                    paths[chain_id] = None
+                continue
+
+            for chain_id in reversed(chain):
+                name = tags[chain_id][0]
+                parent_path = name if parent_path is None else f"{parent_path}|{name}"
+                paths[chain_id] = parent_path
+
+        return paths
+
+    def resolve_tag_paths(self):
+        # The tag tree is kept between syncs until the database changes
+        version = self._data_version()
+        if self.tag_paths is None or version != self.tag_paths_version:
+            self.tag_paths = self._load_tag_paths()
+            self.tag_paths_version = version
+        return self.tag_paths
+
+    def _fetch_rows(self, query, params=()):
+        # Streams the result of a query in chunks instead of one fetchall()
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(self.FETCH_SIZE)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cursor.close()
+
+    @contextmanager
+    def _read_transaction(self):
+        # Runs several reads against one snapshot of the database. Otherwise the
+        # Sample Manager can commit between two of them, leaving files whose
+        # folder we never saw.
+        self.conn.execute("BEGIN;")
+        try:
+            yield
+        finally:
+            self.conn.commit()
+
+    def _folder_ranges(self, folder_path, folders):
+        # The folder ranges to query and the paths to keep from them (None for
+        # all). A few folders are read with queries of their own, many from
+        # the whole prefix at once.
+        if folders is None:
+            return [folder_range(folder_path)], None
+        if len(folders) > self.MAX_FOLDER_QUERIES:
+            return [folder_range(folder_path)], set(folders)
+        return [folder_range(path, recursive=False) for path in sorted(folders)], None
+
+    def _fetch_folder_contents(self, folder_path, folders=None):
+        # Pulls folders, files, file tags and sample metadata for the whole
+        # prefix with one query per table and groups them per folder in memory:
+        # {folder_id: (path, {file_id: [name, loop, [tag_id, ...], key, tempo]})}
+        # With folders, only those exact folders are kept.
+        ranges, wanted = self._folder_ranges(folder_path, folders)
+        contents = {}
+        files = {}
+        sample_meta_query = self._sample_meta_query()
+        with self._read_transaction():
+            for bounds in ranges:
+                for folder_id, path in self._fetch_rows(self.FOLDERS_QUERY, bounds):
+                    if wanted is None or path in wanted:
+                        contents[folder_id] = (path, {})
+
+                for file_id, folder_id, name, loop in self._fetch_rows(
+                    self.FILES_QUERY, bounds
+                ):
+                    folder = contents.get(folder_id)
+                    if folder is not None:
+                        file = [name, loop, [], None, None]
+                        files[file_id] = file
+                        folder[1][file_id] = file
+
+                for file_id, tag_id in self._fetch_rows(self.FILE_TAGS_QUERY, bounds):
+                    file = files.get(file_id)
+                    if file is not None:
+                        file[2].append(tag_id)
+
+                for file_id, key, tempo in self._fetch_rows(sample_meta_query, bounds):
+                    file = files.get(file_id)
+                    if file is not None:
+                        file[3] = key
+                        file[4] = tempo
+
+        return contents
+
+    def _file_tags(self, tag_ids, unmapped_tags):
+        tags = set()
+        for tag_id in tag_ids:
+            tag_name = self.tag_paths.get(tag_id)
+            if tag_name is None:
+                continue
+            destinations = self.tag_targets.get(tag_id)
+            if destinations is None:
+                unmapped_tags.add(tag_name)
+            else:
+                tags.update(destinations)
+        return tags
+
+    def _meta_tags(self, files):
+        # Derives the Type, Key and Tempo tags of every file, one lookup per
+        # column in the tables built when the importer was created. Values of
+        # an unexpected type (a REAL key, a TEXT tempo) are coerced, and key
+        # codes that can't be are counted as unknown.
+        key_table = self.key_tags
+        edges = self.tempo_edges
+        tempo_table = self.tempo_tags
+        meta_tags = []
+        for _, loop, _, key, tempo in files:
+            tags = [self.TYPE_TAGS[loop == 1]]
+
+            code = _as_number(key or 0, int)
+            key_tags = (
+                key_table[code]
+                if code is not None and 0 <= code < len(key_table)
+                else None
+            )
+            if key_tags is None:
+                self.unknown_keys[key] += 1
+            else:
+                tags.extend(key_tags)
+
+            bpm = _as_number(tempo or 0, float)
+            if bpm is not None and bpm > 0 and edges:
+                tags.append(tempo_table[bisect_right(edges, bpm)])
+            meta_tags.append(tags)
+        return meta_tags
+
+    def build_tag_plan(self, folder_path, stats=None, folders=None):
+        # Computes the tags for every file under folder_path, or only in the
+        # given folders, from the database:
+        # ([(folder path, [(file name, tags), ...]), ...], unmapped tags)
+        if stats is None:
+            stats = SyncStats()
+        unmapped_tags = set()
+        self.unknown_keys = Counter()
+        with stats.phase("resolve"):
+            self.resolve_tag_paths()
+        with stats.phase("query"):
+            contents = self._fetch_folder_contents(folder_path, folders)
+
+        with stats.phase("map"):
+            # Resolve the mapping once per tag id instead of per occurrence
+            self.tag_targets = {
+                tag_id: self.tag_map.lookup(tag_path)
+                for tag_id, tag_path in self.tag_paths.items()
+                if tag_path is not None
+            }
+            all_files = [
+                file for _, files in contents.values() for file in files.values()
+            ]
+            meta_tags = iter(self._meta_tags(all_files))
+            plan = []
+            for path, files in contents.values():
+                file_tags = []
+                for file in files.values():
+                    tags = self._file_tags(file[2], unmapped_tags)
+                    tags.update(next(meta_tags))
+                    file_tags.append((file[0], sorted(tags)))
+                plan.append((path, file_tags))
+
+        if self.unknown_keys:
+            counts = self.unknown_keys.most_common()
+            print(
+                "Unknown keys: "
+                + ", ".join(f"{key} ({count} samples)" for key, count in counts)
+            )
+
+        return plan, unmapped_tags
+
+    def _xmp_path(self, folder_path):
+        return f"{folder_path}/Ableton Folder Info/{self.XMP_FILENAME}"
+
+    def _map_folders(
+        self,
+        func,
+        plan,
+        workers,
+        io_threads=0,
+        write_behind=False,
+        on_in_flight=None,
+        **options,
+    ):
+        # Yields (folder path, func(xmp path, file tags, **options)) in plan
+        # order, fanning the XMP work out to a process pool when more than one
+        # worker is asked for. When the generator is closed early, the folders
+        # still in flight are finished all the same and handed to on_in_flight
+        # instead, so their writes aren't lost to the caller.
+        if io_threads > 0 and workers <= 1:
+            yield from self._map_folders_prefetched(
+                func, plan, io_threads, write_behind, on_in_flight, **options
+            )
+            return
+
+        if workers <= 1 or len(plan) <= 1:
+            for path, file_tags in plan:
+                yield path, func(self._xmp_path(path), file_tags, **options)
+            return
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            try:
+                for path, file_tags in plan:
+                    future = executor.submit(
+                        func, self._xmp_path(path), file_tags, **options
+                    )
+                    pending.append((path, future))
+                    # Bound the number of folders in flight to keep memory flat
+                    if len(pending) >= workers * self.FOLDERS_IN_FLIGHT_PER_WORKER:
+                        path, future = pending.popleft()
+                        yield path, future.result()
+                while pending:
+                    path, future = pending.popleft()
+                    yield path, future.result()
+            finally:
+                running = [
+                    (path, future) for path, future in pending if not future.cancel()
+                ]
+                for path, future in running:
+                    try:
+                        result = future.result()
+                    except Exception as error:
+                        print(f"{path}: {error}")
+                        continue
+                    if on_in_flight is not None:
+                        on_in_flight(path, result)
+
+    def _map_folders_prefetched(
+        self, func, plan, io_threads, write_behind, on_in_flight=None, **options
+    ):
+        # Same as the inline _map_folders, but hides storage latency (think
+        # NAS): the sidecars of the next folders are read by a thread pool
+        # while the current one is merged, and with write_behind the writes
+        # are queued on a second pool. Both queues are bounded so memory stays
+        # flat, and a folder is only yielded once its sidecar has been written.
+        window = io_threads * self.FOLDERS_IN_FLIGHT_PER_WORKER
+        folders = iter(plan)
+        reads = deque()
+        writes = deque()
+
+        def read_ahead():
+            while len(reads) < window:
+                folder = next(folders, None)
+                if folder is None:
+                    return
+                path, file_tags = folder
+                xmp_path = self._xmp_path(path)
+                future = readers.submit(read_sidecar, xmp_path)
+                reads.append((path, xmp_path, file_tags, future))
+
+        with ThreadPoolExecutor(io_threads) as readers, ThreadPoolExecutor(
+            io_threads
+        ) as writers:
+            try:
+                read_ahead()
+                while reads:
+                    path, xmp_path, file_tags, future = reads.popleft()
+                    read_ahead()
 
-                tags = set()
-                self.cursor.execute(
-                    "SELECT tag_id FROM file_tags WHERE file_id = ?;",
-                    (file[0],),
+                    started = time.perf_counter()
+                    content = future.result()
+                    waited = time.perf_counter() - started
+
+                    written = []
+                    if write_behind:
+                        options["write"] = lambda xmp_path, xml: written.append(
+                            writers.submit(write_if_different, xmp_path, xml, content)
+                        )
+                    result = func(xmp_path, file_tags, content=content, **options)
+                    result[-1]["xmp-load"] = result[-1].get("xmp-load", 0.0) + waited
+                    writes.append((path, result, written[0] if written else None))
+
+                    # Hand back every folder whose write is done, waiting for
+                    # the oldest one only when too many writes are queued
+                    while writes and (
+                        writes[0][2] is None
+                        or writes[0][2].done()
+                        or len(writes) > window
+                    ):
+                        path, result, write = writes.popleft()
+                        if write is not None:
+                            write.result()
+                        yield path, result
+                while writes:
+                    path, result, write = writes.popleft()
+                    if write is not None:
+                        write.result()
+                    yield path, result
+            finally:
+                for _, _, _, future in reads:
+                    future.cancel()
+                # Queued writes are still carried out on shutdown
+                for path, result, write in writes:
+                    try:
+                        if write is not None:
+                            write.result()
+                    except Exception as error:
+                        print(f"{path}: {error}")
+                        continue
+                    if on_in_flight is not None:
+                        on_in_flight(path, result)
+
+    def _unchanged_folders_filter(self, plan, manifest):
+        # Drops the folders whose planned tags and XMP file are unchanged since
+        # the last sync that was written, returns the plan, folder hashes and
+        # mapping version
+        version = mapping_version(self.tag_map.rules)
+        folder_hashes = {path: tags_hash(file_tags) for path, file_tags in plan}
+        if manifest is not None:
+            plan = [
+                (path, file_tags)
+                for path, file_tags in plan
+                if not manifest.is_unchanged(
+                    path, self._xmp_path(path), folder_hashes[path], version
                 )
-                for tag_name in [
-                    self._fetch_tag_path(tag_id[0]) for tag_id in self.cursor.fetchall()
-                ]:
-                    if tag_name in self.tag_map and self.tag_map[tag_name]:
-                        tag = self.tag_map[tag_name]
-                        tags.add(tag)
-                    else:
-                        unmapped_tags.add(tag_name)
-
-                if file[2] == 1:
-                    tags.add("Type|Loop")
-                else:
-                    tags.add("Type|One Shot")
-
-                # Get the key and tempo from the file
-                self.cursor.execute(
-                    "SELECT key FROM sample_meta WHERE id = ?;",
-                    (file[0],),
+            ]
+        return plan, folder_hashes, version
+
+    def plan_directory(
+        self,
+        folder_path,
+        on_progress=None,
+        cancel_event=None,
+        workers=None,
+        manifest=None,
+        stats=None,
+        folders=None,
+        io_threads=0,
+    ):
+        # Dry run: works out which tags a sync would add by only reading the
+        # keywords already in each sidecar, without building or writing XMP
+        # trees. The result can be passed to sync_directory(plan=...).
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if stats is None:
+            stats = SyncStats()
+        self.last_stats = stats
+
+        tag_plan, unmapped_tags = self.build_tag_plan(folder_path, stats, folders)
+        folder_plan, folder_hashes, version = self._unchanged_folders_filter(
+            tag_plan, manifest
+        )
+        plan = SyncPlan(folder_path, unmapped_tags, folder_hashes, version)
+
+        results = self._map_folders(
+            diff_folder, folder_plan, workers, io_threads=io_threads
+        )
+        try:
+            for folders_done, (path, (file_tags, timings)) in enumerate(results, 1):
+                stats.add_folder(path, timings)
+                plan.add_folder(path, file_tags)
+
+                if on_progress is not None:
+                    on_progress(
+                        {
+                            "folder": path,
+                            "folders_done": folders_done,
+                            "folders_total": len(folder_plan),
+                            "tags_added": plan.num_tags,
+                        }
+                    )
+
+                if cancel_event is not None and cancel_event.is_set():
+                    plan.complete = False
+                    break
+        finally:
+            results.close()
+
+        return plan
+
+    def sync_directory(
+        self,
+        folder_path,
+        dry_run=False,
+        on_tag_added=None,
+        on_progress=None,
+        cancel_event=None,
+        workers=None,
+        manifest=None,
+        streaming=False,
+        stats=None,
+        plan=None,
+        folders=None,
+        io_threads=0,
+        reconcile=False,
+        on_tag_removed=None,
+    ):
+        # folders limits the sync to those folders below folder_path, e.g. the
+        # ones a watcher saw change. io_threads > 0 reads sidecars ahead and
+        # writes them behind on that many threads, for slow network storage.
+        # It only applies with workers=1 and without streaming.
+        # reconcile also removes the keywords an earlier sync added that are
+        # no longer wanted, which needs the manifest's record of them.
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if stats is None:
+            stats = SyncStats()
+        self.last_stats = stats
+        self.last_tags_removed = 0
+        if reconcile and manifest is None:
+            raise ValueError("reconcile needs a manifest of the tags written before")
+        if reconcile and plan is not None:
+            raise ValueError("a dry run plan can't be reconciled")
+
+        if dry_run and not reconcile:
+            plan = self.plan_directory(
+                folder_path,
+                on_progress=on_progress,
+                cancel_event=cancel_event,
+                workers=workers,
+                manifest=manifest,
+                stats=stats,
+                folders=folders,
+                io_threads=io_threads,
+            )
+            if on_tag_added is not None:
+                for file_path, tag in plan.iter_tags():
+                    on_tag_added({"file_path": file_path, "tag": tag})
+            return (plan.num_tags, list(plan.unmapped_tags))
+
+        num_tags_added = 0
+        num_tags_removed = 0
+        stale_tags = {}
+        if plan is None:
+            tag_plan, unmapped_tags = self.build_tag_plan(folder_path, stats, folders)
+            full_plan = tag_plan
+            tag_plan, folder_hashes, version = self._unchanged_folders_filter(
+                tag_plan, manifest
+            )
+            if reconcile:
+                # A sync that didn't reconcile can leave stale tags in folders
+                # the manifest sees as unchanged, so those are kept as well
+                changed = set(path for path, _ in tag_plan)
+                tag_plan, stale_tags = self._reconcile_plan(full_plan, manifest)
+                tag_plan = [
+                    (path, entries)
+                    for path, entries in tag_plan
+                    if path in changed or stale_tags[path]
+                ]
+        else:
+            # Only the folders with tags to add need to be visited, the others
+            # can be recorded in the manifest right away
+            tag_plan = plan.folders
+            unmapped_tags = plan.unmapped_tags
+            folder_hashes = plan.folder_hashes
+            version = plan.mapping_version
+            planned_folders = set(path for path, _ in tag_plan)
+            if manifest is not None and plan.complete:
+                for path in folder_hashes:
+                    if path not in planned_folders:
+                        manifest.record(
+                            path, self._xmp_path(path), folder_hashes[path], version
+                        )
+
+        def record(path, result):
+            # Books one folder whose sidecar has been handled. The manifest
+            # goes first, so the tags we wrote are always on record.
+            nonlocal num_tags_added, num_tags_removed
+            num_added, added, removed, timings = result
+            num_tags_added += num_added
+            num_tags_removed += len(removed)
+            if manifest is not None and not dry_run:
+                manifest.record(
+                    path, self._xmp_path(path), folder_hashes[path], version
                 )
-                # fetch the result
-                result = self.cursor.fetchone()
-
-                if result and result[0] != 0:
-                    if result[0] not in self.KEY_MAP:
-                        print(f"Unknown key: {result[0]}")
-                    else:
-                        root, mode = self.KEY_MAP[result[0]]
-                        if root is not None and mode is not None:
-                            tags.add(f"Key|{root}")
-                            tags.add(f"Key|{mode}")
+                manifest.forget_written(path, stale_tags.get(path, ()))
+                manifest.add_written(path, added)
 
-                for tag in tags:
-                    if xmp.add_tag(file[1], tag):
-                        num_tags_added += 1
-                        if on_tag_added is not None:
-                            on_tag_added(
-                                {"file_path": f"{folder[1]}/{file[1]}", "tag": tag}
-                            )
+            print(path)
+            stats.add_folder(path, timings)
+            if on_tag_added is not None:
+                for file_name, tag in added:
+                    on_tag_added({"file_path": f"{path}/{file_name}", "tag": tag})
+            if on_tag_removed is not None:
+                for file_name, tag in removed:
+                    on_tag_removed({"file_path": f"{path}/{file_name}", "tag": tag})
+
+        results = self._map_folders(
+            sync_folder,
+            tag_plan,
+            workers,
+            # Streaming reads and writes the sidecar as it goes
+            io_threads=0 if streaming else io_threads,
+            write_behind=True,
+            # Folders still being written when we cancel or fail are booked
+            # too, or their tags would be missing from the manifest
+            on_in_flight=record,
+            dry_run=dry_run,
+            # The manifest keeps track of what we add
+            collect_tags=on_tag_added is not None or manifest is not None,
+            # Streaming can only add keywords
+            streaming=streaming and not reconcile,
+            reconcile=reconcile,
+        )
+        try:
+            for folders_done, (path, result) in enumerate(results, 1):
+                record(path, result)
 
-            if not dry_run:
-                xmp.save_if_changed()
+                if on_progress is not None:
+                    on_progress(
+                        {
+                            "folder": path,
+                            "folders_done": folders_done,
+                            "folders_total": len(tag_plan),
+                            "tags_added": num_tags_added,
+                            "tags_removed": num_tags_removed,
+                        }
+                    )
 
-        self.cursor.close()
-        self.conn.close()
+                if cancel_event is not None and cancel_event.is_set():
+                    break
+        finally:
+            results.close()
+            self.last_tags_removed = num_tags_removed
+            if manifest is not None:
+                manifest.commit()
 
         return (num_tags_added, list(unmapped_tags))
+
+    def _reconcile_plan(self, tag_plan, manifest):
+        # Turns [(folder, [(file name, tags)])] into [(folder, [(file name, tags,
+        # stale tags)])], the stale tags being the ones we added before that are
+        # no longer wanted. Files that left the folder keep no tags of ours.
+        # Also returns the stale (file name, tag) pairs per folder.
+        reconcile_plan = []
+        stale_tags = {}
+        for path, file_tags in tag_plan:
+            written = manifest.written_tags(path)
+            entries = []
+            stale_pairs = []
+            for file_name, tags in file_tags:
+                stale = sorted(written.pop(file_name, set()).difference(tags))
+                entries.append((file_name, tags, stale))
+                stale_pairs.extend((file_name, tag) for tag in stale)
+            for file_name, tags in sorted(written.items()):
+                entries.append((file_name, [], sorted(tags)))
+                stale_pairs.extend((file_name, tag) for tag in sorted(tags))
+            reconcile_plan.append((path, entries))
+            stale_tags[path] = stale_pairs
+        return reconcile_plan, stale_tags
+
+
+def row_hash(*values):
+    # CRC32 of a database row for the folder signatures, the values are kept
+    # apart by their repr so ("ab", "c") and ("a", "bc") differ
+    return zlib.crc32(repr(values).encode("utf-8"))
+
+
+def _as_number(value, kind):
+    # kind(value), or None when the database holds something else
+    try:
+        return kind(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def key_tag_table(key_map):
+    # Lookup table from ADSR key code to its Key| tags: () for "no key" and
+    # None for codes we don't know
+    table = [None] * (max(key_map, default=0) + 1)
+    table[0] = ()
+    for code, (root, mode) in key_map.items():
+        if root is not None and mode is not None:
+            table[code] = (f"Key|{root}", f"Key|{mode}")
+        else:
+            table[code] = ()
+    return table
+
+
+def tempo_buckets(edges):
+    # Turns BPM boundaries such as (90, 110) into the sorted edges and the tag
+    # of every bucket: Tempo|Under 90, Tempo|90-110 and Tempo|110+
+    edges = sorted(edges)
+    if not edges:
+        return [], []
+    tags = [f"Tempo|Under {edges[0]:g}"]
+    tags.extend(f"Tempo|{low:g}-{high:g}" for low, high in zip(edges, edges[1:]))
+    tags.append(f"Tempo|{edges[-1]:g}+")
+    return edges, tags
+
+
+class SyncPlan:
+    # The outcome of a dry run: for every folder the files and tags that a
+    # sync would add, plus what is needed to record the folders in a manifest
+    # once the plan has been applied
+
+    def __init__(self, folder_path, unmapped_tags, folder_hashes, mapping_version):
+        self.folder_path = folder_path
+        self.unmapped_tags = unmapped_tags
+        self.folder_hashes = folder_hashes
+        self.mapping_version = mapping_version
+        self.folders = []
+        self.num_tags = 0
+        self.complete = True
+
+    def add_folder(self, folder_path, file_tags):
+        if file_tags:
+            self.folders.append((folder_path, file_tags))
+            self.num_tags += sum(len(tags) for _, tags in file_tags)
+
+    def iter_tags(self):
+        for folder_path, file_tags in self.folders:
+            for file_name, tags in file_tags:
+                for tag in tags:
+                    yield f"{folder_path}/{file_name}", tag
+
+
+def diff_folder(xmp_path, file_tags, content=None):
+    # Returns the planned tags that are missing from a sidecar, per file, and
+    # the time it took to read it
+    started = time.perf_counter()
+    existing_keywords = read_keywords(xmp_path, content)
+    timings = {"xmp-load": time.perf_counter() - started}
+
+    started = time.perf_counter()
+    diff = []
+    for file_name, tags in file_tags:
+        existing = existing_keywords.get(file_name, ())
+        new_tags = [tag for tag in tags if tag not in existing]
+        if new_tags:
+            diff.append((file_name, new_tags))
+    timings["merge"] = time.perf_counter() - started
+    return diff, timings
+
+
+def sync_folder(
+    xmp_path,
+    file_tags,
+    dry_run=False,
+    collect_tags=False,
+    streaming=False,
+    content=None,
+    write=None,
+    reconcile=False,
+):
+    # Merges the planned tags into one folder's XMP sidecar. Kept at module
+    # level so it can run in a worker process. Returns the number of tags
+    # added, the added (file name, tag) pairs if collect_tags is set, the
+    # removed (file name, tag) pairs and the seconds spent per phase. content
+    # is the prefetched sidecar, write(xmp path, xml) queues the write instead
+    # of doing it here. With reconcile, file_tags are (file name, tags, stale
+    # tags) and the stale tags are removed in the same pass.
+    timings = {}
+    started = time.perf_counter()
+    if streaming:
+        # Parsing, merging and writing are interleaved when streaming
+        added = stream_add_tags(xmp_path, file_tags, dry_run=dry_run)
+        timings["merge"] = time.perf_counter() - started
+        return len(added), added if collect_tags else [], [], timings
+
+    xmp = AbletonXMPFile(xmp_path, content)
+    timings["xmp-load"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    num_tags_added = 0
+    added = []
+    removed = []
+    for file_name, tags, *stale in file_tags:
+        if reconcile:
+            removed.extend(
+                (file_name, tag) for tag in xmp.remove_tags(file_name, stale[0])
+            )
+            if not tags:
+                continue
+        new_tags = xmp.add_tags(file_name, tags)
+        num_tags_added += len(new_tags)
+        if collect_tags:
+            added.extend((file_name, tag) for tag in new_tags)
+    timings["merge"] = time.perf_counter() - started
+
+    if not dry_run and xmp.is_changed:
+        started = time.perf_counter()
+        xml = xmp.dump()
+        timings["serialize"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        if write is None:
+            write_if_different(xmp_path, xml)
+        else:
+            write(xmp_path, xml)
+        xmp.is_changed = False
+        timings["write"] = time.perf_counter() - started
+
+    return num_tags_added, added, removed, timings
@@ -0,0 +1,294 @@
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from abletonxmpfile import AbletonXMPFile
+from adsrimporter import ADSRImporter
+
+TOP_LEVEL_TAGS = ["Drums", "Bass", "Synth", "Keys", "FX", "Vocals", "Guitar", "Pads"]
+
+
+def generate_tags(depth, fanout):
+    # Returns [(id, name, parent_id)] for a tag tree of the given depth
+    tags = []
+    level = []
+    for name in TOP_LEVEL_TAGS:
+        tags.append((len(tags) + 1, name, -1))
+        level.append(len(tags))
+    for d in range(1, depth):
+        next_level = []
+        for parent_id in level:
+            for i in range(fanout):
+                tags.append((len(tags) + 1, f"Level{d} {i}", parent_id))
+                next_level.append(len(tags))
+        level = next_level
+    return tags
+
+
+def generate_library(
+    work_dir,
+    num_samples,
+    files_per_folder=100,
+    tags_per_file=8,
+    tag_depth=3,
+    tag_fanout=4,
+    existing_ratio=0.5,
+    seed=0,
+):
+    # Creates a synthetic ADSR database plus the matching sample folders. A
+    # share of the files already has an Ableton sidecar entry with some of
+    # their tags, so a sync has to merge rather than only append.
+    rnd = random.Random(seed)
+    library_root = os.path.join(work_dir, "Samples")
+    db_path = os.path.join(work_dir, "adsr.db3")
+
+    tags = generate_tags(tag_depth, tag_fanout)
+    key_codes = list(ADSRImporter.KEY_MAP) + [0, 0, 0, 99]
+
+    conn = sqlite3.connect(db_path)
+    conn.executescript("""
+        CREATE TABLE folders (id INTEGER PRIMARY KEY, path TEXT);
+        CREATE TABLE files (
+            id INTEGER PRIMARY KEY, folder_id INTEGER, name TEXT, loop INTEGER
+        );
+        CREATE TABLE file_tags (file_id INTEGER, tag_id INTEGER);
+        CREATE TABLE tags (
+            id INTEGER PRIMARY KEY, name TEXT, parent_id INTEGER, type INTEGER
+        );
+        CREATE TABLE sample_meta (id INTEGER PRIMARY KEY, key INTEGER, tempo REAL);
+        CREATE INDEX files_folder_id ON files(folder_id);
+        CREATE INDEX file_tags_file_id ON file_tags(file_id);
+        """)
+    conn.executemany(
+        "INSERT INTO tags VALUES (?, ?, ?, 0);",
+        tags,
+    )
+
+    num_folders = max(1, -(-num_samples // files_per_folder))
+    folders = [
+        (i + 1, f"{library_root}/Pack {i // 20:04d}/Folder {i % 20:02d}")
+        for i in range(num_folders)
+    ]
+    conn.executemany("INSERT INTO folders VALUES (?, ?);", folders)
+
+    files = [
+        (i + 1, i // files_per_folder + 1, f"Sample {i:07d}.wav", rnd.random() < 0.3)
+        for i in range(num_samples)
+    ]
+    conn.executemany("INSERT INTO files VALUES (?, ?, ?, ?);", files)
+
+    file_tags = {
+        file_id: rnd.sample(range(1, len(tags) + 1), min(tags_per_file, len(tags)))
+        for file_id, *_ in files
+    }
+    conn.executemany(
+        "INSERT INTO file_tags VALUES (?, ?);",
+        (
+            (file_id, tag_id)
+            for file_id, tag_ids in file_tags.items()
+            for tag_id in tag_ids
+        ),
+    )
+    conn.executemany(
+        "INSERT INTO sample_meta VALUES (?, ?, ?);",
+        (
+            (file_id, rnd.choice(key_codes), rnd.choice([0, 90, 120, 128, 140, 174]))
+            for file_id, *_ in files
+        ),
+    )
+    conn.commit()
+    conn.close()
+
+    importer = ADSRImporter(db_path, {})
+    tag_paths = importer._load_tag_paths()
+    importer.close()
+    for folder_id, path in folders:
+        os.makedirs(path, exist_ok=True)
+        folder_files = files[
+            (folder_id - 1) * files_per_folder : folder_id * files_per_folder
+        ]
+        xmp = AbletonXMPFile(f"{path}/Ableton Folder Info/{ADSRImporter.XMP_FILENAME}")
+        for file_id, _, name, _ in folder_files:
+            if rnd.random() < existing_ratio:
+                tag_ids = file_tags[file_id][: tags_per_file // 2]
+                xmp.add_tags(name, [tag_paths[tag_id] for tag_id in tag_ids])
+        xmp.save_if_changed()
+
+    # Map every tag onto itself except one top-level branch, so unmapped tags
+    # are reported too
+    mapping = {
+        tag_path: tag_path
+        for tag_path in tag_paths.values()
+        if not tag_path.startswith(TOP_LEVEL_TAGS[-1])
+    }
+    return db_path, library_root, mapping
+
+
+def _sidecar_stats(library_root):
+    stats = {}
+    for dir_path, _, file_names in os.walk(library_root):
+        for file_name in file_names:
+            if file_name == ADSRImporter.XMP_FILENAME:
+                path = os.path.join(dir_path, file_name)
+                stat = os.stat(path)
+                stats[path] = (stat.st_mtime_ns, stat.st_size)
+    return stats
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    scale = 1 if sys.platform == "darwin" else 1024
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(rss, rss_children) * scale / (1024 * 1024), 1)
+
+
+def measure_sync(
+    db_path, library_root, mapping, dry_run, workers, streaming, io_threads
+):
+    # Runs in a fresh process so the peak RSS belongs to this sync only
+    queries = 0
+
+    def count_query(statement):
+        nonlocal queries
+        queries += 1
+
+    before = _sidecar_stats(library_root)
+    importer = ADSRImporter(db_path, mapping)
+    importer.conn.set_trace_callback(count_query)
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        with importer:
+            num_tags_added, unmapped = importer.sync_directory(
+                library_root,
+                dry_run=dry_run,
+                workers=workers,
+                streaming=streaming,
+                io_threads=io_threads,
+            )
+    seconds = time.perf_counter() - started
+    after = _sidecar_stats(library_root)
+
+    return {
+        "mode": "dry-run" if dry_run else "write",
+        "seconds": round(seconds, 3),
+        "queries": queries,
+        "peak_rss_mb": _peak_rss_mb(),
+        "files_written": sum(
+            1 for path, stat in after.items() if before.get(path) != stat
+        ),
+        "tags_added": num_tags_added,
+        "unmapped_tags": len(unmapped),
+    }
+
+
+def run_benchmark(args, num_samples, work_dir):
+    started = time.perf_counter()
+    db_path, library_root, mapping = generate_library(
+        work_dir,
+        num_samples,
+        files_per_folder=args.files_per_folder,
+        tags_per_file=args.tags_per_file,
+        tag_depth=args.tag_depth,
+        tag_fanout=args.tag_fanout,
+        existing_ratio=args.existing_ratio,
+        seed=args.seed,
+    )
+    generate_seconds = time.perf_counter() - started
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for dry_run in (True, False):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(
+                measure_sync,
+                db_path,
+                library_root,
+                mapping,
+                dry_run,
+                args.workers,
+                args.stream,
+                args.io_threads,
+            ).result()
+        result.update(
+            samples=num_samples,
+            folders=max(1, -(-num_samples // args.files_per_folder)),
+            generate_seconds=round(generate_seconds, 3),
+        )
+        results.append(result)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark ADSRImporter.sync_directory on a synthetic library"
+    )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        nargs="+",
+        default=[1000, 10000],
+        help="library sizes to benchmark",
+    )
+    parser.add_argument("--files-per-folder", type=int, default=100)
+    parser.add_argument("--tags-per-file", type=int, default=8)
+    parser.add_argument("--tag-depth", type=int, default=3)
+    parser.add_argument("--tag-fanout", type=int, default=4)
+    parser.add_argument(
+        "--existing-ratio",
+        type=float,
+        default=0.5,
+        help="share of files that already have a sidecar entry",
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--io-threads", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", help="generate into this directory and keep it")
+    parser.add_argument("--json", action="store_true", help="print JSON lines")
+    args = parser.parse_args(argv)
+
+    if not args.json:
+        print(
+            f"{'samples':>9} {'mode':>8} {'seconds':>9} {'queries':>8} "
+            f"{'rss MB':>8} {'written':>8} {'tags':>9}"
+        )
+    for num_samples in args.samples:
+        work_dir = args.keep or tempfile.mkdtemp(prefix="ableton-tag-bench-")
+        work_dir = os.path.join(work_dir, str(num_samples))
+        if os.path.exists(os.path.join(work_dir, "adsr.db3")):
+            # Left by an earlier run with --keep, whose sidecars are synced
+            # already. Start over so the results stay comparable.
+            shutil.rmtree(work_dir)
+        elif os.path.isdir(work_dir) and os.listdir(work_dir):
+            parser.error(f"{work_dir} is not empty")
+        os.makedirs(work_dir, exist_ok=True)
+        try:
+            for result in run_benchmark(args, num_samples, work_dir):
+                if args.json:
+                    print(json.dumps(result), flush=True)
+                else:
+                    print(
+                        f"{result['samples']:>9} {result['mode']:>8} "
+                        f"{result['seconds']:>9.3f} {result['queries']:>8} "
+                        f"{result['peak_rss_mb']:>8} {result['files_written']:>8} "
+                        f"{result['tags_added']:>9}",
+                        flush=True,
+                    )
+        finally:
+            if not args.keep:
+                shutil.rmtree(os.path.dirname(work_dir))
+
+
+if __name__ == "__main__":
+    main()
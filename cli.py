@@ -0,0 +1,451 @@
+import argparse
+import contextlib
+import cProfile
+import json
+import sys
+import time
+
+from adsrimporter import ADSRImporter
+from syncjob import SyncJob, load_job
+from syncmanifest import SyncManifest
+from syncstats import SyncStats
+from syncwatcher import SyncWatcher
+from tagmapping import load_mapping_csv
+from xmpindex import XMPIndex
+
+MAPPING_CSV = "data.csv"
+XMP_INDEX_DB = "xmp_index.db"
+
+
+class SyncReport:
+    # Collects per-folder progress of a sync and turns it into a report that
+    # can be written as one JSON document or as NDJSON lines
+
+    def __init__(self, ndjson_output=None):
+        self.ndjson_output = ndjson_output
+        self.started = time.monotonic()
+        self.last_event = self.started
+        self.last_tags_added = 0
+        self.folders = []
+
+    def on_progress(self, event):
+        now = time.monotonic()
+        folder = {
+            "type": "folder",
+            "folder": event["folder"],
+            "seconds": round(now - self.last_event, 6),
+            "tags_added": event["tags_added"] - self.last_tags_added,
+        }
+        self.last_event = now
+        self.last_tags_added = event["tags_added"]
+        self.folders.append(folder)
+        if self.ndjson_output is not None:
+            self.ndjson_output.write(json.dumps(folder) + "\n")
+            self.ndjson_output.flush()
+
+    def summary(self, args, num_tags_added, unmapped):
+        seconds = time.monotonic() - self.started
+        return {
+            "type": "summary",
+            "db": args.db,
+            "directory": args.dir,
+            "dry_run": args.dry_run,
+            "tags_added": num_tags_added,
+            "unmapped_tags": sorted(unmapped),
+            "folders": len(self.folders),
+            "seconds": round(seconds, 6),
+            "folders_per_second": (
+                round(len(self.folders) / seconds, 3) if seconds else None
+            ),
+            "tags_per_second": round(num_tags_added / seconds, 3) if seconds else None,
+        }
+
+
+def run_sync(args):
+    mapping = load_mapping_csv(args.mapping)
+    report = SyncReport(sys.stdout if args.ndjson else None)
+    manifest = SyncManifest(args.manifest) if args.manifest else None
+    stats = SyncStats()
+    profiler = cProfile.Profile() if args.cprofile else None
+
+    # Keep stdout clean for machine readable output
+    log_output = sys.stderr if args.json or args.ndjson else sys.stdout
+    try:
+        if profiler is not None:
+            profiler.enable()
+        with contextlib.redirect_stdout(log_output):
+            with ADSRImporter(
+                args.db,
+                mapping,
+                snapshot_path=args.snapshot,
+                tempo_edges=args.tempo_edges,
+            ) as importer:
+                num_tags_added, unmapped = importer.sync_directory(
+                    args.dir,
+                    dry_run=args.dry_run,
+                    on_progress=report.on_progress,
+                    workers=args.workers,
+                    manifest=manifest,
+                    streaming=args.stream,
+                    stats=stats,
+                    io_threads=args.io_threads,
+                    reconcile=args.reconcile,
+                )
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.cprofile)
+        if manifest is not None:
+            manifest.close()
+
+    summary = report.summary(args, num_tags_added, unmapped)
+    summary["tags_removed"] = importer.last_tags_removed
+    summary["unknown_keys"] = {
+        str(key): count for key, count in importer.unknown_keys.most_common()
+    }
+    if args.profile:
+        summary["profile"] = stats.as_dict()
+    if args.ndjson:
+        print(json.dumps(summary))
+    elif args.json:
+        summary["folder_timings"] = report.folders
+        print(json.dumps(summary, indent=2))
+    else:
+        print(f"Directory: {args.dir}")
+        print(f"{num_tags_added} tags {'to import' if args.dry_run else 'imported'}")
+        if args.reconcile:
+            removed = importer.last_tags_removed
+            print(f"{removed} tags {'to remove' if args.dry_run else 'removed'}")
+        print(f"{summary['folders']} folders in {summary['seconds']:.1f}s")
+        if unmapped:
+            print("Unmapped Tags:")
+            for tag in summary["unmapped_tags"]:
+                print(" * " + tag)
+        if args.profile:
+            print(stats.format())
+    return 0
+
+
+def run_watch(args, stop_event=None):
+    mapping = load_mapping_csv(args.mapping)
+    manifest = SyncManifest(args.manifest) if args.manifest else None
+    output = sys.stdout
+
+    def on_sync(result):
+        if args.json:
+            print(
+                json.dumps(
+                    {
+                        "type": "sync",
+                        "folders": result["folders"],
+                        "tags_added": result["tags_added"],
+                        "tags_removed": result["tags_removed"],
+                        "unmapped_tags": sorted(result["unmapped_tags"]),
+                    }
+                ),
+                file=output,
+                flush=True,
+            )
+        else:
+            folders = result["folders"]
+            scope = "all folders" if folders is None else f"{len(folders)} folders"
+            print(
+                f"Synced {scope}: {result['tags_added']} tags imported",
+                file=output,
+                flush=True,
+            )
+
+    log_output = sys.stderr if args.json else sys.stdout
+    importer = ADSRImporter(
+        args.db,
+        mapping,
+        snapshot_path=args.snapshot,
+        tempo_edges=args.tempo_edges,
+    )
+    watcher = SyncWatcher(
+        importer,
+        args.dir,
+        poll_interval=args.poll,
+        debounce=args.debounce,
+        on_sync=on_sync,
+        workers=args.workers,
+        manifest=manifest,
+        streaming=args.stream,
+        io_threads=args.io_threads,
+        reconcile=args.reconcile,
+    )
+    try:
+        with contextlib.redirect_stdout(log_output):
+            watcher.run(stop_event)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+        importer.close()
+        if manifest is not None:
+            manifest.close()
+    return 0
+
+
+def run_job(args):
+    job = SyncJob(
+        load_job(args.job), parallel=args.parallel, tempo_edges=args.tempo_edges
+    )
+    manifest = SyncManifest(args.manifest) if args.manifest else None
+    output = sys.stdout
+
+    def on_result(result):
+        if args.json:
+            record = {key: value for key, value in result.items() if key != "stats"}
+            print(json.dumps(dict(record, type="sync")), file=output, flush=True)
+        else:
+            print(
+                f"{result['root']}: {result['tags_added']} tags "
+                f"{'to import' if args.dry_run else 'imported'} in "
+                f"{result['folders']} folders",
+                file=output,
+                flush=True,
+            )
+
+    started = time.monotonic()
+    log_output = sys.stderr if args.json else sys.stdout
+    try:
+        with contextlib.redirect_stdout(log_output):
+            results = job.run(
+                dry_run=args.dry_run,
+                workers=args.workers,
+                manifest=manifest,
+                io_threads=args.io_threads,
+                reconcile=args.reconcile,
+                on_result=on_result,
+            )
+    finally:
+        if manifest is not None:
+            manifest.close()
+
+    summary = {
+        "type": "summary",
+        "syncs": len(results),
+        "tags_added": sum(result["tags_added"] for result in results),
+        "seconds": round(time.monotonic() - started, 6),
+    }
+    if args.json:
+        print(json.dumps(summary))
+    else:
+        print(
+            f"{summary['tags_added']} tags in {summary['syncs']} syncs "
+            f"in {summary['seconds']:.1f}s"
+        )
+    return 0
+
+
+def run_discover(args):
+    mapping = load_mapping_csv(args.mapping)
+    with contextlib.redirect_stdout(sys.stderr):
+        with ADSRImporter(args.db, mapping) as importer:
+            tags = importer.discover_tags(args.dir)
+    if args.unmapped:
+        tags = [tag for tag in tags if tag[2] is None]
+
+    if args.json:
+        print(
+            json.dumps(
+                [
+                    {
+                        "tag": tag_path,
+                        "samples": samples,
+                        "destinations": (
+                            None if destinations is None else list(destinations)
+                        ),
+                    }
+                    for tag_path, samples, destinations in tags
+                ],
+                indent=2,
+            )
+        )
+        return 0
+
+    for tag_path, samples, destinations in tags:
+        if destinations is None:
+            target = "(unmapped)"
+        else:
+            target = ";".join(destinations) or "-"
+        print(f"{samples:>8}  {tag_path}  -> {target}")
+    return 0
+
+
+def run_index(args):
+    index = XMPIndex(args.index)
+    try:
+        started = time.monotonic()
+        counts = index.update(args.root, workers=args.workers)
+        report = dict(counts, seconds=round(time.monotonic() - started, 6))
+        if args.tag:
+            report["files"] = index.files_with_tag(args.tag)
+        if args.histogram:
+            report["histogram"] = index.tag_histogram()
+    finally:
+        index.close()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return 0
+
+    print(
+        f"{report['found']} sidecars, {report['indexed']} indexed, "
+        f"{report['removed']} removed in {report['seconds']:.1f}s"
+    )
+    for file_path in report.get("files", []):
+        print(file_path)
+    for keyword, count in report.get("histogram", []):
+        print(f"{count:>8}  {keyword}")
+    return 0
+
+
+def tempo_edges(value):
+    # "90,110,130" -> (90.0, 110.0, 130.0), an empty string turns tempo tags off
+    try:
+        return tuple(float(edge) for edge in value.split(",") if edge.strip())
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a list of BPM values: {value}")
+
+
+def add_sync_options(parser):
+    # Options shared by every command that syncs
+    parser.add_argument(
+        "--workers", type=int, default=None, help="worker processes (default: CPUs)"
+    )
+    parser.add_argument("--manifest", help="manifest file to skip unchanged folders")
+    parser.add_argument(
+        "--tempo-edges",
+        type=tempo_edges,
+        default=ADSRImporter.DEFAULT_TEMPO_EDGES,
+        help="comma separated BPM boundaries of the Tempo| tags, '' for none",
+    )
+    parser.add_argument(
+        "--io-threads",
+        type=int,
+        default=0,
+        help="read and write sidecars on this many threads in a single process "
+        "(for network storage, implies --workers 1)",
+    )
+    parser.add_argument(
+        "--reconcile",
+        action="store_true",
+        help="also remove tags earlier syncs added that are no longer wanted "
+        "(needs --manifest)",
+    )
+
+
+def add_sync_arguments(parser):
+    parser.add_argument("--db", required=True, help="ADSR Sample Manager database")
+    parser.add_argument("--dir", required=True, help="directory to sync")
+    parser.add_argument("--mapping", default=MAPPING_CSV, help="tag mapping CSV")
+    add_sync_options(parser)
+    parser.add_argument(
+        "--snapshot", help="copy the database here first and sync from the copy"
+    )
+    parser.add_argument(
+        "--stream", action="store_true", help="stream XMP files instead of loading"
+    )
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="cli", description="Headless ADSR to Ableton tag sync"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    sync = commands.add_parser("sync", help="sync tags into a sample directory")
+    add_sync_arguments(sync)
+    sync.add_argument("--dry-run", action="store_true", help="don't write files")
+    sync.add_argument(
+        "--profile", action="store_true", help="report time per phase and folder"
+    )
+    sync.add_argument("--cprofile", help="write cProfile stats to this file")
+    output = sync.add_mutually_exclusive_group()
+    output.add_argument("--json", action="store_true", help="print a JSON report")
+    output.add_argument(
+        "--ndjson", action="store_true", help="print one JSON line per folder"
+    )
+    sync.set_defaults(func=run_sync)
+
+    watch = commands.add_parser(
+        "watch", help="keep syncing the folders that change in the database"
+    )
+    add_sync_arguments(watch)
+    watch.add_argument(
+        "--poll", type=float, default=2.0, help="seconds between database checks"
+    )
+    watch.add_argument(
+        "--debounce",
+        type=float,
+        default=3.0,
+        help="seconds the database has to be quiet before syncing",
+    )
+    watch.add_argument(
+        "--json", action="store_true", help="print one JSON line per sync"
+    )
+    watch.set_defaults(func=run_watch)
+
+    job = commands.add_parser(
+        "run", help="run the syncs listed in a job file concurrently"
+    )
+    job.add_argument("--job", required=True, help="JSON job file")
+    job.add_argument("--dry-run", action="store_true", help="don't write files")
+    add_sync_options(job)
+    job.add_argument(
+        "--parallel", type=int, default=None, help="syncs to run at the same time"
+    )
+    job.add_argument("--json", action="store_true", help="print JSON lines")
+    job.set_defaults(func=run_job)
+
+    discover = commands.add_parser(
+        "discover", help="list the tags used below a directory and their samples"
+    )
+    discover.add_argument("--db", required=True, help="ADSR Sample Manager database")
+    discover.add_argument("--dir", required=True, help="directory to look at")
+    discover.add_argument("--mapping", default=MAPPING_CSV, help="tag mapping CSV")
+    discover.add_argument(
+        "--unmapped", action="store_true", help="only list unmapped tags"
+    )
+    discover.add_argument("--json", action="store_true", help="print JSON")
+    discover.set_defaults(func=run_discover)
+
+    index = commands.add_parser(
+        "index", help="index the tags in Ableton's sidecars into SQLite"
+    )
+    index.add_argument("--root", required=True, help="sample library root")
+    index.add_argument("--index", default=XMP_INDEX_DB, help="index database")
+    index.add_argument(
+        "--workers", type=int, default=None, help="worker processes (default: CPUs)"
+    )
+    index.add_argument("--tag", help="list the samples carrying this tag")
+    index.add_argument(
+        "--histogram", action="store_true", help="list tags by number of samples"
+    )
+    index.add_argument("--json", action="store_true", help="print a JSON report")
+    index.set_defaults(func=run_index)
+
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if getattr(args, "reconcile", False) and not args.manifest:
+        parser.error("--reconcile needs --manifest")
+    if getattr(args, "io_threads", 0) > 0:
+        # More processes already overlap their I/O, the threads only read
+        # ahead and write behind for a single one
+        if args.workers is None:
+            args.workers = 1
+        elif args.workers > 1:
+            parser.error("--io-threads runs in a single process, use --workers 1")
+        if getattr(args, "stream", False):
+            parser.error("--io-threads can't be combined with --stream")
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
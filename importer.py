@@ -1,13 +1,23 @@
 import os
+import queue
+import threading
+import time
 
 import customtkinter
 import tksheet
-import csv
 from adsrimporter import ADSRImporter
+from syncmanifest import SyncManifest
+from tagmapping import MappingTable
 
 DEFAULT_DB_PATH = os.path.expanduser("~/Library/Application Support/ADSR/adsr_1_7.db3")
 DEFAULT_DIRECTORY = os.path.expanduser("~/Music/Ableton/User Library/Samples")
 MAPPING_CSV = "data.csv"
+MANIFEST_DB = "sync_manifest.db"
+SYNC_POLL_INTERVAL_MS = 100
+MAX_LOG_LINES_PER_POLL = 200
+SAVE_MAPPING_DELAY_MS = 1000
+# Above this many new rows the sheet is reloaded instead of updated per row
+MAX_ROWS_INSERTED_INDIVIDUALLY = 200
 
 
 class AbletonTagImporter(customtkinter.CTk):
@@ -27,10 +37,18 @@ class AbletonTagImporter(customtkinter.CTk):
             self.db3_path = None
 
         self.directory_path = None
-        self.mapping_list = []
+        self.mapping = MappingTable()
+        self.save_mapping_id = None
         self.unmapped_tags = []
         self.mapping_changed = False
 
+        self.sync_queue = queue.Queue()
+        self.sync_thread = None
+        self.cancel_event = None
+        self.sync_started = None
+        # (db3 path, directory, mapping, plan) of the last completed dry run
+        self.last_plan = None
+
         self.load_mapping()
 
         
@@ -56,13 +74,25 @@ class AbletonTagImporter(customtkinter.CTk):
         self.logbox.grid(row=2, column=0, columnspan=2, sticky="nsew")
         self.logbox.configure(state="disabled")
 
-        # Sync button
+        # Progress
+        self.progressbar = customtkinter.CTkProgressBar(self)
+        self.progressbar.set(0)
+        self.progressbar.grid(row=3, column=0, padx=10, pady=(10, 0), sticky="ew")
+        self.progress_label = customtkinter.CTkLabel(self, text="")
+        self.progress_label.grid(row=3, column=1, padx=10, pady=(10, 0))
+
+        # Sync and cancel buttons
         self.sync_button = customtkinter.CTkButton(self, text="Sync", command=self.sync)
         self.sync_button.configure(state="disabled")
-        self.sync_button.grid(row=3, column=0, columnspan=2, pady=10)
+        self.sync_button.grid(row=4, column=0, pady=10)
+        self.cancel_button = customtkinter.CTkButton(
+            self, text="Cancel", command=self.cancel_sync
+        )
+        self.cancel_button.configure(state="disabled")
+        self.cancel_button.grid(row=4, column=1, pady=10)
 
         table_frame = customtkinter.CTkFrame(self, bg_color="red")
-        table_frame.grid(row=0, column=2, rowspan=4, sticky="nsew", padx=10, pady=10)
+        table_frame.grid(row=0, column=2, rowspan=5, sticky="nsew", padx=10, pady=10)
         table_frame.grid_columnconfigure(0, weight=1)
         table_frame.grid_rowconfigure(0, weight=1)
         self.table = tksheet.Sheet(
@@ -92,37 +122,52 @@ class AbletonTagImporter(customtkinter.CTk):
         )
         self.table.span("A").readonly()
 
-        self.table.set_sheet_data(self.mapping_list)
+        self.table.set_sheet_data([list(row) for row in self.mapping.rows])
         self.table.bind("<<SheetModified>>", self.table_updated)
         self.table.set_options(auto_resize_columns=200)
 
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+
     def log(self, message):
         self.logbox.configure(state="normal")
         self.logbox.insert("end", message + "\n")
         self.logbox.configure(state="disabled")
 
     def table_updated(self, event):
-        self.save_mapping()
+        if event["added"]["rows"] or event["deleted"]["rows"] or event["moved"]["rows"]:
+            # Rows were added or removed in the sheet itself, start over from it
+            self.mapping = MappingTable(self.table.get_sheet_data())
+        else:
+            for row, column in event["cells"]["table"]:
+                if column == 1:
+                    self.mapping.set_value(row, self.table.get_cell_data(row, 1))
+        self.mapping_changed = True
+        self.schedule_save_mapping()
 
     def load_mapping(self):
         try:
-            with open(self.csv_file, "r", encoding="utf-8") as file:
-                reader = csv.reader(file)
-                for row in reader:
-                    if len(row) > 1:
-                        self.mapping_list.append(row)
-                    elif len(row) == 1:
-                        self.mapping_list.append([row[0], None])
-            self.mapping_list = sorted(self.mapping_list, key=lambda x: x[0])
+            self.mapping = MappingTable.load_csv(self.csv_file)
             self.mapping_changed = False
         except FileNotFoundError:
             pass
 
+    def schedule_save_mapping(self):
+        # Bursts of edits (e.g. a paste) end up in a single write
+        if self.save_mapping_id is not None:
+            self.after_cancel(self.save_mapping_id)
+        self.save_mapping_id = self.after(SAVE_MAPPING_DELAY_MS, self.save_mapping)
+
     def save_mapping(self):
-        with open(self.csv_file, "w", encoding="utf-8") as file:
-            writer = csv.writer(file)
-            for key, value in self.mapping_list:
-                writer.writerow([key, value if value is not None else ""])
+        self.save_mapping_id = None
+        if self.mapping_changed:
+            self.mapping.save_csv(self.csv_file)
+            self.mapping_changed = False
+
+    def on_close(self):
+        if self.save_mapping_id is not None:
+            self.after_cancel(self.save_mapping_id)
+            self.save_mapping()
+        self.destroy()
 
     def open_directory_selection(self):
         self.directory_path = customtkinter.filedialog.askdirectory(
@@ -135,7 +180,6 @@ class AbletonTagImporter(customtkinter.CTk):
         )
         self.directory_label.configure(text="Directory to Sync: " + self.directory_path)
         self.sync(dry_run=True)
-        self.sync_button.configure(state="normal")
 
     def open_db3_selection(self):
         self.db3_path = customtkinter.filedialog.askopenfilename(
@@ -145,55 +189,198 @@ class AbletonTagImporter(customtkinter.CTk):
         )
         self.db3_label.configure(text="DB3 File Path: " + self.db3_path)
 
-    def log_tag_event(self, event):
-        self.log(f"Added tag '{event['tag']}' to '{event['file_path']}'")
+    def format_tag_event(self, event):
+        return f"Added tag '{event['tag']}' to '{event['file_path']}'"
 
     def sync(self, dry_run=False):
         if not self.directory_path:
             self.log("No directory selected")
             return
+        if self.sync_thread is not None:
+            return
 
-        mapping = {row[0]: row[1] for row in self.mapping_list}
-        sync = ADSRImporter(self.db3_path, mapping)
+        mapping = self.mapping.as_dict()
+
+        # Apply the dry run's plan instead of redoing the work, as long as it
+        # was made for the same database, directory and mapping
+        plan = None
+        if not dry_run and self.last_plan is not None:
+            rules = {key: value for key, value in mapping.items() if value}
+            if self.last_plan[:3] == (self.db3_path, self.directory_path, rules):
+                plan = self.last_plan[3]
+        self.last_plan = None
+
+        self.cancel_event = threading.Event()
+        self.sync_started = time.monotonic()
+        self.progressbar.set(0)
+        self.progress_label.configure(text="")
+        self.sync_button.configure(state="disabled")
+        self.directory_button.configure(state="disabled")
+        self.db3_button.configure(state="disabled")
+        self.cancel_button.configure(state="normal")
+
+        self.sync_thread = threading.Thread(
+            target=self.run_sync,
+            args=(self.db3_path, self.directory_path, mapping, dry_run, plan),
+            daemon=True,
+        )
+        self.sync_thread.start()
+        self.after(SYNC_POLL_INTERVAL_MS, self.process_sync_queue)
 
-        # TODO: We should really run this on a separate thread
-        num_imported_tags, unmapped = sync.sync_directory(
-            self.directory_path, dry_run=dry_run, on_tag_added=self.log_tag_event
+    def run_sync(self, db3_path, directory_path, mapping, dry_run, plan):
+        # Runs on the worker thread, the UI only hears about it via the queue
+        manifest = None
+        sync = None
+        try:
+            manifest = SyncManifest(
+                os.path.join(os.path.dirname(self.csv_file), MANIFEST_DB)
+            )
+            sync = ADSRImporter(db3_path, mapping)
+            on_progress = lambda event: self.sync_queue.put(("progress", event))
+            if dry_run:
+                plan = sync.plan_directory(
+                    directory_path,
+                    on_progress=on_progress,
+                    cancel_event=self.cancel_event,
+                    manifest=manifest,
+                )
+                for file_path, tag in plan.iter_tags():
+                    self.sync_queue.put(
+                        ("tag", {"file_path": file_path, "tag": tag})
+                    )
+                result = (plan.num_tags, list(plan.unmapped_tags))
+            else:
+                result = sync.sync_directory(
+                    directory_path,
+                    on_tag_added=lambda event: self.sync_queue.put(("tag", event)),
+                    on_progress=on_progress,
+                    cancel_event=self.cancel_event,
+                    manifest=manifest,
+                    plan=plan,
+                )
+                plan = None
+            # Samples per tag, so the unmapped tags can be listed by impact
+            usage = {
+                tag_path: samples
+                for tag_path, samples, _ in sync.discover_tags(directory_path)
+            }
+            self.sync_queue.put(
+                ("done", (db3_path, directory_path, mapping, plan, result, usage))
+            )
+        except Exception as e:
+            self.sync_queue.put(("error", e))
+        finally:
+            if sync is not None:
+                sync.close()
+            if manifest is not None:
+                manifest.close()
+
+    def process_sync_queue(self):
+        lines = []
+        skipped = 0
+        progress = None
+        finished = None
+        while True:
+            try:
+                kind, payload = self.sync_queue.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "tag":
+                if len(lines) < MAX_LOG_LINES_PER_POLL:
+                    lines.append(self.format_tag_event(payload))
+                else:
+                    skipped += 1
+            elif kind == "progress":
+                progress = payload
+            else:
+                finished = (kind, payload)
+
+        if skipped:
+            lines.append(f"... and {skipped} more tags")
+        if lines:
+            self.log("\n".join(lines))
+        if progress is not None:
+            self.update_progress(progress)
+
+        if finished is None:
+            self.after(SYNC_POLL_INTERVAL_MS, self.process_sync_queue)
+        else:
+            self.sync_finished(*finished)
+
+    def update_progress(self, progress):
+        elapsed = max(time.monotonic() - self.sync_started, 1e-6)
+        self.progressbar.set(progress["folders_done"] / progress["folders_total"])
+        self.progress_label.configure(
+            text=f"{progress['folders_done']}/{progress['folders_total']} folders, "
+            f"{progress['tags_added'] / elapsed:.0f} tags/s"
         )
 
-        for tag in unmapped:
-            if tag not in mapping:
-                self.add_to_mapping(tag)
+    def cancel_sync(self):
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+            self.cancel_button.configure(state="disabled")
 
-        self.table.set_sheet_data(
-            self.mapping_list, keep_formatting=False, reset_highlights=True
-        )
+    def sync_finished(self, kind, payload):
+        self.sync_thread = None
+        self.cancel_button.configure(state="disabled")
+        self.directory_button.configure(state="normal")
+        self.db3_button.configure(state="normal")
+        self.sync_button.configure(state="normal")
 
-        for tag in unmapped:
-            for i, row in enumerate(self.mapping_list):
-                if tag in row:
-                    self.table.highlight_cells(row=i, column=1, bg="red")
-                    break
+        if kind == "error":
+            self.log(f"Sync failed: {payload}")
+            return
 
-        self.log(f"Directory: {self.directory_path}")
-        self.log(f"{num_imported_tags} tags imported")
-        self.log("Unmapped Tags:")
-        for tag in unmapped:
-            self.log(" * " + tag)
+        db3_path, directory_path, mapping, plan, result, usage = payload
+        num_imported_tags, unmapped = result
+        if plan is not None and plan.complete:
+            # Rows without a destination don't affect the plan, so adding the
+            # unmapped tags below doesn't invalidate it
+            rules = {key: value for key, value in mapping.items() if value}
+            self.last_plan = (db3_path, directory_path, rules, plan)
 
-        print(unmapped)
+        self.add_to_mapping(sorted(tag for tag in unmapped if tag not in mapping))
 
-    def add_to_mapping(self, tag):
-        for i, row in enumerate(self.mapping_list):
-            if tag <= row[0]:
-                if tag != row[0]:
-                    self.mapping_list.insert(i, [tag, None])
-                    self.mapping_changed = True
-                    break
+        self.table.dehighlight_all(redraw=False)
+        for tag in unmapped:
+            i = self.mapping.index(tag)
+            if i is not None:
+                self.table.highlight_cells(row=i, column=1, bg="red", redraw=False)
+        self.table.redraw()
+
+        if self.cancel_event.is_set():
+            self.log("Sync cancelled")
+        self.log(f"Directory: {directory_path}")
+        if plan is not None:
+            self.log(f"{num_imported_tags} tags to import")
         else:
-            self.mapping_list.append([tag, None])
-            self.mapping_changed = True
+            self.log(f"{num_imported_tags} tags imported")
+        self.log("Unmapped Tags:")
+        for tag in sorted(unmapped, key=lambda tag: (-usage.get(tag, 0), tag)):
+            self.log(f" * {tag} ({usage.get(tag, 0)} samples)")
 
+        print(unmapped)
 
-app = AbletonTagImporter()
-app.mainloop()
+    def add_to_mapping(self, tags):
+        new_rows = [(i, tag) for tag in tags if (i := self.mapping.add(tag)) is not None]
+        if not new_rows:
+            return
+
+        if len(new_rows) > MAX_ROWS_INSERTED_INDIVIDUALLY:
+            self.table.set_sheet_data(
+                [list(row) for row in self.mapping.rows], redraw=False
+            )
+        else:
+            # tags are sorted, so each index already accounts for the rows
+            # inserted before it
+            for i, tag in new_rows:
+                self.table.insert_row([tag, None], idx=i, redraw=False)
+        self.mapping_changed = True
+        self.schedule_save_mapping()
+
+
+if __name__ == "__main__":
+    # Guarded so sync worker processes can import this module without
+    # opening another window
+    app = AbletonTagImporter()
+    app.mainloop()
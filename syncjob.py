@@ -0,0 +1,146 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from adsrimporter import ADSRImporter
+from syncstats import SyncStats
+from tagmapping import TagMapping, load_mapping_csv
+
+DEFAULT_MAPPING = "data.csv"
+
+
+def load_job(job_path):
+    # Reads the syncs of a job file:
+    # {"syncs": [{"db": "adsr.db3", "root": "/Samples", "mapping": "data.csv"}]}
+    # Relative paths are relative to the job file, mapping defaults to data.csv
+    with open(job_path, "r", encoding="utf-8") as file:
+        job = json.load(file)
+    base_path = os.path.dirname(os.path.abspath(job_path))
+    entries = []
+    for i, sync in enumerate(job.get("syncs", [])):
+        if "db" not in sync or "root" not in sync:
+            raise ValueError(f"{job_path}: sync {i + 1} needs a db and a root")
+        entries.append(
+            {
+                "db": os.path.join(base_path, sync["db"]),
+                "root": os.path.normpath(os.path.join(base_path, sync["root"])),
+                "mapping": os.path.join(
+                    base_path, sync.get("mapping", DEFAULT_MAPPING)
+                ),
+            }
+        )
+    return entries
+
+
+class SyncJob:
+    # Runs several (database, root, mapping) syncs in one go. Entries of the
+    # same database share the resolved tag tree and entries with the same
+    # mapping file share the compiled TagMapping. A folder reachable from more
+    # than one root is only synced by the first entry listing it, so two syncs
+    # never write the same sidecar, and the roots run concurrently.
+
+    def __init__(
+        self, entries, parallel=None, tempo_edges=ADSRImporter.DEFAULT_TEMPO_EDGES
+    ):
+        self.entries = entries
+        if parallel is None:
+            parallel = min(len(entries), os.cpu_count() or 1)
+        self.parallel = max(1, parallel)
+        self.tempo_edges = tempo_edges
+
+    def _importers(self):
+        mappings = {}
+        tag_paths = {}
+        importers = []
+        try:
+            for entry in self.entries:
+                mapping = mappings.get(entry["mapping"])
+                if mapping is None:
+                    mapping = TagMapping(load_mapping_csv(entry["mapping"]))
+                    mappings[entry["mapping"]] = mapping
+                importer = ADSRImporter(
+                    entry["db"],
+                    mapping,
+                    tempo_edges=self.tempo_edges,
+                    tag_paths=tag_paths.get(entry["db"]),
+                )
+                importers.append(importer)
+                if entry["db"] not in tag_paths:
+                    tag_paths[entry["db"]] = importer.resolve_tag_paths()
+        except BaseException:
+            for importer in importers:
+                importer.close()
+            raise
+        return importers
+
+    def _claim_folders(self, importers):
+        # Returns, per entry, the folders it syncs (None for all of them) and
+        # how many were left to an earlier entry
+        claimed = set()
+        scopes = []
+        for entry, importer in zip(self.entries, importers):
+            paths = importer.folder_paths(entry["root"])
+            own = [path for path in paths if path not in claimed]
+            claimed.update(own)
+            if len(own) == len(paths):
+                scopes.append((None, 0))
+            else:
+                scopes.append((own, len(paths) - len(own)))
+        return scopes
+
+    def run(
+        self,
+        dry_run=False,
+        workers=None,
+        manifest=None,
+        io_threads=0,
+        reconcile=False,
+        on_result=None,
+    ):
+        # Returns one result per entry, in job order. on_result is called as
+        # soon as an entry finishes, from the thread that ran it.
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers_per_root = max(1, workers // self.parallel)
+
+        def run_entry(entry, importer, folders, skipped):
+            stats = SyncStats()
+            num_tags_added, unmapped = 0, []
+            if folders is None or folders:
+                num_tags_added, unmapped = importer.sync_directory(
+                    entry["root"],
+                    dry_run=dry_run,
+                    workers=workers_per_root,
+                    manifest=manifest,
+                    stats=stats,
+                    folders=folders,
+                    io_threads=io_threads,
+                    reconcile=reconcile,
+                )
+            result = dict(
+                entry,
+                tags_added=num_tags_added,
+                tags_removed=importer.last_tags_removed,
+                unmapped_tags=sorted(unmapped),
+                folders=len(stats.folders),
+                folders_skipped=skipped,
+                stats=stats,
+            )
+            if on_result is not None:
+                on_result(result)
+            return result
+
+        importers = self._importers()
+        try:
+            scopes = self._claim_folders(importers)
+            with ThreadPoolExecutor(self.parallel) as executor:
+                futures = [
+                    executor.submit(run_entry, entry, importer, folders, skipped)
+                    for entry, importer, (folders, skipped) in zip(
+                        self.entries, importers, scopes
+                    )
+                ]
+                return [future.result() for future in futures]
+        finally:
+            for importer in importers:
+                importer.close()
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+from tagmapping import parse_destinations
+
+
+def tags_hash(file_tags):
+    # Stable hash of the tags planned for one folder
+    data = json.dumps(sorted([name, sorted(tags)] for name, tags in file_tags))
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+def mapping_version(tag_map):
+    # Only rules that map somewhere count, so the empty rows the GUI adds for
+    # newly found tags don't make the next sync re-read every sidecar
+    rules = []
+    for key, value in tag_map.items():
+        destinations = parse_destinations(value)
+        if destinations is not None:
+            rules.append((key, list(destinations)))
+    data = json.dumps(sorted(rules))
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+def xmp_stat(xmp_path):
+    try:
+        stat = os.stat(xmp_path)
+    except FileNotFoundError:
+        return None, None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class SyncManifest:
+    # Remembers, per folder, the inputs of the last sync that was written to
+    # disk so a re-sync can skip folders where nothing changed, and which
+    # keywords the importer itself added so a reconcile never removes the ones
+    # added in Live. Can be shared by syncs running on several threads.
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(manifest_path, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS folders (
+                path TEXT PRIMARY KEY,
+                tags_hash TEXT NOT NULL,
+                mapping_version TEXT NOT NULL,
+                xmp_mtime_ns INTEGER,
+                xmp_size INTEGER
+            );
+            """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS written_tags (
+                folder TEXT NOT NULL,
+                file_name TEXT NOT NULL,
+                keyword TEXT NOT NULL,
+                PRIMARY KEY (folder, file_name, keyword)
+            ) WITHOUT ROWID;
+            """)
+        self.entries = {
+            row[0]: tuple(row[1:])
+            for row in self.conn.execute(
+                "SELECT path,tags_hash,mapping_version,xmp_mtime_ns,xmp_size "
+                "FROM folders;"
+            )
+        }
+        self.pending = {}
+
+    def is_unchanged(self, folder_path, xmp_path, folder_hash, version):
+        entry = self.entries.get(folder_path)
+        if entry is None:
+            return False
+        return entry == (folder_hash, version, *xmp_stat(xmp_path))
+
+    def record(self, folder_path, xmp_path, folder_hash, version):
+        entry = (folder_hash, version, *xmp_stat(xmp_path))
+        with self.lock:
+            self.entries[folder_path] = entry
+            self.pending[folder_path] = entry
+
+    def written_tags(self, folder_path):
+        # {file name: keywords the importer added} for one folder
+        written = {}
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT file_name,keyword FROM written_tags WHERE folder = ?;",
+                (folder_path,),
+            ).fetchall()
+        for file_name, keyword in rows:
+            written.setdefault(file_name, set()).add(keyword)
+        return written
+
+    def add_written(self, folder_path, file_tags):
+        # file_tags are the (file name, keyword) pairs a sync added
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO written_tags VALUES (?, ?, ?);",
+                [(folder_path, file_name, tag) for file_name, tag in file_tags],
+            )
+
+    def forget_written(self, folder_path, file_tags):
+        with self.lock:
+            self.conn.executemany(
+                "DELETE FROM written_tags "
+                "WHERE folder = ? AND file_name = ? AND keyword = ?;",
+                [(folder_path, file_name, tag) for file_name, tag in file_tags],
+            )
+
+    def commit(self):
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?, ?);",
+                [(path, *entry) for path, entry in self.pending.items()],
+            )
+            self.conn.commit()
+            self.pending = {}
+
+    def close(self):
+        self.commit()
+        self.conn.close()
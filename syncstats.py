@@ -0,0 +1,60 @@
+import heapq
+import time
+from contextlib import contextmanager
+
+PHASES = ("query", "resolve", "map", "xmp-load", "merge", "serialize", "write")
+
+
+class SyncStats:
+    # Accumulates the wall time spent per phase of a sync, plus the total per
+    # folder so the slowest folders can be reported. on_phase, when given, is
+    # called as on_phase(phase, seconds, folder) for every measurement.
+
+    def __init__(self, on_phase=None):
+        self.on_phase = on_phase
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        self.counts = dict.fromkeys(PHASES, 0)
+        self.folders = []
+
+    @contextmanager
+    def phase(self, name, folder=None):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started, folder)
+
+    def add(self, name, seconds, folder=None):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        self.counts[name] = self.counts.get(name, 0) + 1
+        if self.on_phase is not None:
+            self.on_phase(name, seconds, folder)
+
+    def add_folder(self, folder, timings):
+        for name, seconds in timings.items():
+            self.add(name, seconds, folder)
+        self.folders.append((sum(timings.values()), folder))
+
+    def slowest_folders(self, n=10):
+        return heapq.nlargest(n, self.folders)
+
+    def as_dict(self, slowest=10):
+        return {
+            "phases": {
+                name: {"seconds": round(seconds, 6), "count": self.counts[name]}
+                for name, seconds in self.seconds.items()
+            },
+            "slowest_folders": [
+                {"folder": folder, "seconds": round(seconds, 6)}
+                for seconds, folder in self.slowest_folders(slowest)
+            ],
+        }
+
+    def format(self, slowest=10):
+        lines = [f"{'phase':<10} {'seconds':>10} {'count':>8}"]
+        for name, seconds in self.seconds.items():
+            lines.append(f"{name:<10} {seconds:>10.3f} {self.counts[name]:>8}")
+        lines.append("Slowest folders:")
+        for seconds, folder in self.slowest_folders(slowest):
+            lines.append(f"{seconds:>10.3f}  {folder}")
+        return "\n".join(lines)
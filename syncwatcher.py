@@ -0,0 +1,136 @@
+import os
+import threading
+import time
+
+import adsrdb
+from syncstats import SyncStats
+
+
+def _stat(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class SyncWatcher:
+    # Keeps a directory in sync while the Sample Manager is running. Polling is
+    # a PRAGMA data_version and two stat() calls, so idling costs next to
+    # nothing. Once the database has been quiet for `debounce` seconds (or has
+    # kept changing for `max_delay`), only the folders that changed are synced.
+    # Rows appended since the last checkpoint point at those folders
+    # directly. Deletes and edits in place fall back to comparing every
+    # folder's checksum, which costs about as much as planning the whole
+    # directory. An edit landing together with appends is caught by the next
+    # fallback, as its folder's checksum is still the old one.
+
+    def __init__(
+        self,
+        importer,
+        folder_path,
+        poll_interval=2.0,
+        debounce=3.0,
+        max_delay=30.0,
+        on_sync=None,
+        **sync_options,
+    ):
+        self.importer = importer
+        self.folder_path = folder_path
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.on_sync = on_sync
+        self.sync_options = sync_options
+        # data_version only moves for commits made by other connections, so
+        # the watcher polls the live database on a connection of its own
+        self.conn = adsrdb.connect_readonly(importer.db_path)
+        self.db_state = self._db_state()
+        self.checkpoint = None
+        self.signatures = None
+
+    def _db_state(self):
+        (data_version,) = self.conn.execute("PRAGMA data_version;").fetchone()
+        db_path = self.importer.db_path
+        return data_version, _stat(db_path), _stat(f"{db_path}-wal")
+
+    def db_changed(self):
+        state = self._db_state()
+        if state == self.db_state:
+            return False
+        self.db_state = state
+        return True
+
+    def sync_all(self):
+        # The checkpoint is taken first, so whatever is committed in between
+        # shows up as changed next time rather than being missed
+        self.checkpoint = self.importer.table_checkpoint()
+        self.signatures = self.importer.folder_signatures(self.folder_path)
+        return self._sync(None)
+
+    def sync_changes(self):
+        # Syncs the folders that changed since the last checkpoint, returns
+        # the result of the sync or None when nothing relevant changed
+        self.importer.refresh_snapshot()
+        checkpoint = self.importer.table_checkpoint()
+        appended = self.importer.appended_folders(
+            self.folder_path, self.checkpoint, checkpoint
+        )
+        self.checkpoint = checkpoint
+        if appended is None:
+            signatures = self.importer.folder_signatures(self.folder_path)
+            changed = [
+                path
+                for path, signature in signatures.items()
+                if self.signatures.get(path) != signature
+            ]
+            self.signatures = signatures
+        else:
+            changed = sorted(appended)
+            if changed:
+                self.signatures.update(
+                    self.importer.folder_signatures(self.folder_path, folders=changed)
+                )
+        if not changed:
+            return None
+        return self._sync(changed)
+
+    def _sync(self, folders):
+        stats = SyncStats()
+        num_tags_added, unmapped = self.importer.sync_directory(
+            self.folder_path, folders=folders, stats=stats, **self.sync_options
+        )
+        result = {
+            "folders": folders,
+            "tags_added": num_tags_added,
+            "tags_removed": self.importer.last_tags_removed,
+            "unmapped_tags": unmapped,
+            "stats": stats,
+        }
+        if self.on_sync is not None:
+            self.on_sync(result)
+        return result
+
+    def run(self, stop_event=None):
+        # Blocks until stop_event is set, starting with a full sync
+        if stop_event is None:
+            stop_event = threading.Event()
+        self.sync_all()
+        first_change = last_change = None
+        while not stop_event.wait(self.poll_interval):
+            now = time.monotonic()
+            if self.db_changed():
+                last_change = now
+                if first_change is None:
+                    first_change = now
+            if first_change is None:
+                continue
+            if (
+                now - last_change >= self.debounce
+                or now - first_change >= self.max_delay
+            ):
+                first_change = last_change = None
+                self.sync_changes()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,168 @@
+import csv
+import os
+import tempfile
+from bisect import bisect_left
+
+from abletonxmpfile import copy_file_mode
+
+
+def load_mapping_csv(csv_path):
+    # Reads the Source,Destination rows of the mapping table. Sources without
+    # a destination map to None and are reported as unmapped.
+    return MappingTable.load_csv(csv_path).as_dict()
+
+
+class MappingTable:
+    # The Source/Destination rows behind the GUI table, kept sorted by source
+    # with a parallel list of keys so lookups and inserts use bisect instead
+    # of scanning every row
+
+    def __init__(self, rows=()):
+        rows = {row[0]: row[1] if len(row) > 1 else None for row in rows}
+        self.rows = [[key, rows[key]] for key in sorted(rows)]
+        self.keys = [row[0] for row in self.rows]
+
+    @classmethod
+    def load_csv(cls, csv_path):
+        with open(csv_path, "r", encoding="utf-8") as file:
+            return cls(
+                [row[0], row[1] or None] if len(row) > 1 else [row[0], None]
+                for row in csv.reader(file)
+                if row
+            )
+
+    def save_csv(self, csv_path):
+        # Written to a temp file first so a crash never leaves half a mapping
+        folder_path = os.path.dirname(os.path.abspath(csv_path))
+        with tempfile.NamedTemporaryFile(
+            "w",
+            encoding="utf-8",
+            newline="",
+            dir=folder_path,
+            prefix=".",
+            suffix=".tmp",
+            delete=False,
+        ) as file:
+            writer = csv.writer(file)
+            for key, value in self.rows:
+                writer.writerow([key, value if value is not None else ""])
+        copy_file_mode(file.name, csv_path)
+        os.replace(file.name, csv_path)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, key):
+        return self.index(key) is not None
+
+    def index(self, key):
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        return None
+
+    def add(self, key, value=None):
+        # Inserts a new source in sorted position and returns its row index,
+        # or None when it is already in the table
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return None
+        self.keys.insert(i, key)
+        self.rows.insert(i, [key, value])
+        return i
+
+    def set_value(self, i, value):
+        self.rows[i][1] = value or None
+
+    def as_dict(self):
+        return {key: value for key, value in self.rows}
+
+
+SEPARATOR = "|"
+WILDCARD = "*"
+DROP = "-"
+DESTINATION_SEPARATOR = ";"
+
+
+class _Node:
+    __slots__ = ("children", "exact", "prefix")
+
+    def __init__(self):
+        self.children = {}
+        self.exact = None
+        self.prefix = None
+
+
+def parse_destinations(destination):
+    # "" or None: no rule, "-": drop the tag, "A;B": map to several tags
+    if destination is None or not destination.strip():
+        return None
+    if destination.strip() == DROP:
+        return ()
+    return tuple(
+        tag.strip() for tag in destination.split(DESTINATION_SEPARATOR) if tag.strip()
+    )
+
+
+class TagMapping:
+    # Compiles Source -> Destination rules into a trie keyed on the
+    # "|"-separated tag path. Besides exact rules, a source ending in "|*"
+    # matches everything below it and a "*" in the destination is replaced by
+    # the matched remainder, e.g. "Drums|*" -> "Drum Kit|*". Exact rules win
+    # over wildcards and deeper wildcards over shallower ones.
+
+    def __init__(self, rules):
+        self.rules = dict(rules)
+        self._root = _Node()
+        self._cache = {}
+        for source, destination in self.rules.items():
+            destinations = parse_destinations(destination)
+            if destinations is None:
+                continue
+            segments = source.split(SEPARATOR)
+            wildcard = segments[-1] == WILDCARD
+            if wildcard:
+                segments = segments[:-1]
+            node = self._root
+            for segment in segments:
+                node = node.children.setdefault(segment, _Node())
+            if wildcard:
+                node.prefix = destinations
+            else:
+                node.exact = destinations
+
+    def lookup(self, tag_path):
+        # Returns the destination tags for a source tag, () when it is
+        # dropped and None when no rule matches
+        try:
+            return self._cache[tag_path]
+        except KeyError:
+            pass
+
+        segments = tag_path.split(SEPARATOR)
+        node = self._root
+        match = None
+        for i, segment in enumerate(segments):
+            if node.prefix is not None:
+                match = (node.prefix, SEPARATOR.join(segments[i:]))
+            node = node.children.get(segment)
+            if node is None:
+                break
+        else:
+            if node.exact is not None:
+                match = (node.exact, None)
+
+        if match is None:
+            result = None
+        else:
+            destinations, remainder = match
+            if remainder is None:
+                result = destinations
+            else:
+                result = tuple(
+                    destination.replace(WILDCARD, remainder)
+                    for destination in destinations
+                )
+
+        self._cache[tag_path] = result
+        return result
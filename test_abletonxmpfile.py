@@ -3,8 +3,9 @@ from datetime import datetime
 from lxml import etree
 from tempfile import NamedTemporaryFile
 import os
+import stat
 
-from abletonxmpfile import AbletonXMPFile
+from abletonxmpfile import AbletonXMPFile, stream_add_tags, write_atomic
 
 
 class TestAbletonXMPFile(unittest.TestCase):
@@ -93,6 +94,50 @@ class TestAbletonXMPFile(unittest.TestCase):
         self.assertEqual(tags[0].text, tag)
         self.assertTrue(self.xmp_file.is_changed)
 
+    def test_add_tags(self):
+        # Test adding several tags at once, only new ones are reported
+        file_path = "new_file.wav"
+        added = self.xmp_file.add_tags(file_path, ["music", "sound", "music"])
+        self.assertEqual(added, ["music", "sound"])
+        self.assertEqual(self.xmp_file.add_tags(file_path, ["sound"]), [])
+        self.assertEqual(
+            self.xmp_file.get_keywords(file_path), frozenset(["music", "sound"])
+        )
+        self.assertTrue(self.xmp_file.is_changed)
+
+    def test_remove_tags(self):
+        # Test removing tags, only the ones that were there are reported
+        file_path = "new_file.wav"
+        self.xmp_file.add_tags(file_path, ["music", "sound"])
+        self.xmp_file.is_changed = False
+        self.assertEqual(self.xmp_file.remove_tags(file_path, ["noise"]), [])
+        self.assertEqual(self.xmp_file.remove_tags("missing.wav", ["music"]), [])
+        self.assertFalse(self.xmp_file.is_changed)
+
+        self.assertEqual(
+            self.xmp_file.remove_tags(file_path, ["music", "noise"]), ["music"]
+        )
+        self.assertEqual(self.xmp_file.get_keywords(file_path), frozenset(["sound"]))
+        self.assertNotIn("music", self.xmp_file.dump())
+        self.assertTrue(self.xmp_file.is_changed)
+
+    def test_index_existing_items(self):
+        # Test that items already in the file are found without duplicating them
+        xmp_file = AbletonXMPFile("test.xmp")
+        self.assertTrue(xmp_file.has_item("Sample with > xml entities.wav"))
+        self.assertIn("Drums|Kick", xmp_file.get_keywords("Sample 1.wav"))
+        self.assertEqual(xmp_file.add_tags("Sample 1.wav", ["Drums|Kick"]), [])
+        self.assertFalse(xmp_file.is_changed)
+        self.assertEqual(
+            xmp_file.add_tags("Sample 1.wav", ["Drums|Loop"]), ["Drums|Loop"]
+        )
+        items = xmp_file.root.xpath(
+            "//ablFR:items/rdf:Bag/rdf:li[ablFR:filePath='Sample 1.wav']",
+            namespaces=xmp_file.nsmap,
+        )
+        self.assertEqual(len(items), 1)
+        self.assertTrue(xmp_file.is_changed)
+
     def test_dump(self):
         # Test dumping the XML content
         xml = self.xmp_file.dump()
@@ -114,6 +159,90 @@ class TestAbletonXMPFile(unittest.TestCase):
             saved_xml = file.read()
         self.assertEqual(xml, saved_xml)
 
+    def test_save_if_changed_skips_identical_content(self):
+        # Test that a save which would only bump MetadataDate doesn't write
+        with NamedTemporaryFile(delete=False, suffix=".xmp") as temp_file:
+            temp_file_path = temp_file.name
+        os.remove(temp_file_path)
+
+        xmp_file = AbletonXMPFile(temp_file_path)
+        xmp_file.add_tag("new_file.wav", "music")
+        self.assertTrue(xmp_file.save_if_changed())
+
+        xmp_file = AbletonXMPFile(temp_file_path)
+        xmp_file.is_changed = True
+        self.assertFalse(xmp_file.save_if_changed())
+        self.assertFalse(xmp_file.is_changed)
+
+        xmp_file.add_tag("new_file.wav", "sound")
+        self.assertTrue(xmp_file.save_if_changed())
+        self.assertIn(
+            "sound", AbletonXMPFile(temp_file_path).get_keywords("new_file.wav")
+        )
+        os.remove(temp_file_path)
+
+    @unittest.skipIf(os.name == "nt", "POSIX file modes")
+    def test_write_keeps_file_mode(self):
+        # Replacing a sidecar keeps its mode, new ones get the umask default
+        with NamedTemporaryFile(delete=False, suffix=".xmp") as temp_file:
+            temp_file.write(self.xmp_file.dump().encode())
+            temp_file_path = temp_file.name
+        os.chmod(temp_file_path, 0o644)
+
+        def mode(path):
+            return stat.S_IMODE(os.stat(path).st_mode)
+
+        write_atomic(temp_file_path, self.xmp_file.dump())
+        self.assertEqual(mode(temp_file_path), 0o644)
+        stream_add_tags(temp_file_path, [("new_file.wav", ["music"])])
+        self.assertEqual(mode(temp_file_path), 0o644)
+
+        os.remove(temp_file_path)
+        umask = os.umask(0)
+        os.umask(umask)
+        write_atomic(temp_file_path, self.xmp_file.dump())
+        self.assertEqual(mode(temp_file_path), 0o666 & ~umask)
+        os.remove(temp_file_path)
+
+    def test_stream_add_tags(self):
+        # Test merging tags while streaming a copy of test.xmp
+        with open("test.xmp", "rb") as file:
+            xml = file.read()
+        with NamedTemporaryFile(delete=False, suffix=".xmp") as temp_file:
+            temp_file.write(xml)
+            temp_file_path = temp_file.name
+
+        file_tags = [
+            ("Sample 1.wav", ["Drums|Kick", "Drums|Loop"]),
+            ("new_file.wav", ["music", "sound"]),
+        ]
+        added = stream_add_tags(temp_file_path, file_tags, dry_run=True)
+        self.assertEqual(
+            added,
+            [
+                ("Sample 1.wav", "Drums|Loop"),
+                ("new_file.wav", "music"),
+                ("new_file.wav", "sound"),
+            ],
+        )
+        with open(temp_file_path, "rb") as file:
+            self.assertEqual(file.read(), xml)
+
+        self.assertEqual(stream_add_tags(temp_file_path, file_tags), added)
+        xmp_file = AbletonXMPFile(temp_file_path)
+        self.assertIn("Drums|Loop", xmp_file.get_keywords("Sample 1.wav"))
+        self.assertIn("Source|Somewhere", xmp_file.get_keywords("Sample 1.wav"))
+        self.assertEqual(
+            xmp_file.get_keywords("new_file.wav"), frozenset(["music", "sound"])
+        )
+        self.assertTrue(xmp_file.has_item("Sample with > xml entities.wav"))
+
+        # Nothing left to add, so the file is not rewritten
+        mtime = os.stat(temp_file_path).st_mtime_ns
+        self.assertEqual(stream_add_tags(temp_file_path, file_tags), [])
+        self.assertEqual(os.stat(temp_file_path).st_mtime_ns, mtime)
+        os.remove(temp_file_path)
+
 
 if __name__ == "__main__":
     unittest.main()
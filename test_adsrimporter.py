@@ -0,0 +1,589 @@
+import unittest
+import os
+import sqlite3
+import threading
+from unittest.mock import ANY
+from tempfile import TemporaryDirectory
+
+from abletonxmpfile import AbletonXMPFile
+from adsrdb import folder_range
+from adsrimporter import ADSRImporter, tempo_buckets
+from syncmanifest import SyncManifest
+
+
+def create_test_db(db_path, root):
+    # Minimal ADSR Sample Manager schema with two folders under root and two
+    # sibling folders that should never be touched
+    conn = sqlite3.connect(db_path)
+    conn.executescript("""
+        CREATE TABLE folders (id INTEGER PRIMARY KEY, path TEXT);
+        CREATE TABLE files (
+            id INTEGER PRIMARY KEY, folder_id INTEGER, name TEXT, loop INTEGER
+        );
+        CREATE TABLE file_tags (file_id INTEGER, tag_id INTEGER);
+        CREATE TABLE tags (
+            id INTEGER PRIMARY KEY, name TEXT, parent_id INTEGER, type INTEGER
+        );
+        CREATE TABLE sample_meta (id INTEGER PRIMARY KEY, key INTEGER);
+        """)
+    conn.executemany(
+        "INSERT INTO folders VALUES (?, ?);",
+        [
+            (1, f"{root}/Samples"),
+            (2, f"{root}/Samples/Kicks"),
+            (3, f"{root}/Other"),
+            (4, f"{root}/Samples2"),
+        ],
+    )
+    conn.executemany(
+        "INSERT INTO files VALUES (?, ?, ?, ?);",
+        [
+            (1, 1, "Loop 1.wav", 1),
+            (2, 2, "Kick 1.wav", 0),
+            (3, 2, "Kick 2.wav", 0),
+            (4, 3, "Other.wav", 0),
+            (5, 4, "Sibling.wav", 0),
+        ],
+    )
+    conn.executemany(
+        "INSERT INTO tags VALUES (?, ?, ?, 0);",
+        [
+            (1, "Drums", -1),
+            (2, "Kick", 1),
+            (3, "Snare", 1),
+            (4, "Character", -1),
+            (5, "Dark", 4),
+            (6, "Cycle A", 7),
+            (7, "Cycle B", 6),
+            (8, "Orphan", 42),
+            (9, "Orphan Child", 8),
+        ],
+    )
+    conn.executemany(
+        "INSERT INTO file_tags VALUES (?, ?);",
+        [(1, 1), (1, 5), (1, 6), (2, 2), (2, 5), (2, 9), (3, 2), (4, 3), (5, 2)],
+    )
+    conn.executemany(
+        "INSERT INTO sample_meta VALUES (?, ?);", [(1, 30), (2, 0), (3, 99)]
+    )
+    conn.commit()
+    conn.close()
+
+
+TAG_MAP = {
+    "Drums": "Drums",
+    "Drums|Kick": "Drums|Kick",
+    "Drums|Snare": "Drums|Snare",
+    "Character|Dark": None,
+}
+
+
+class TestADSRImporter(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.root = self.temp_dir.name
+        for folder in ("Samples/Kicks", "Other", "Samples2"):
+            os.makedirs(os.path.join(self.root, folder))
+        self.db_path = os.path.join(self.root, "adsr.db3")
+        create_test_db(self.db_path, self.root)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def xmp_path(self, folder):
+        return os.path.join(
+            self.root, folder, "Ableton Folder Info", ADSRImporter.XMP_FILENAME
+        )
+
+    def test_tag_paths(self):
+        importer = ADSRImporter(self.db_path, TAG_MAP)
+        tag_paths = importer._load_tag_paths()
+        self.assertEqual(tag_paths[2], "Drums|Kick")
+        self.assertEqual(tag_paths[5], "Character|Dark")
+        # Cycles and missing parents don't resolve instead of crashing
+        self.assertIsNone(tag_paths[6])
+        self.assertIsNone(tag_paths[7])
+        self.assertIsNone(tag_paths[8])
+        self.assertIsNone(tag_paths[9])
+
+    def test_dry_run(self):
+        importer = ADSRImporter(self.db_path, TAG_MAP)
+        events = []
+        num_tags_added, unmapped = importer.sync_directory(
+            f"{self.root}/Samples",
+            dry_run=True,
+            on_tag_added=events.append,
+            workers=1,
+        )
+        # Loop 1: Drums, Type|Loop, Key|A, Key|Minor; Kick 1/2: Kick, One Shot
+        self.assertEqual(num_tags_added, 8)
+        self.assertEqual(len(events), 8)
+        self.assertEqual(unmapped, ["Character|Dark"])
+        self.assertFalse(os.path.exists(self.xmp_path("Samples")))
+
+    def test_progress_and_cancel(self):
+        importer = ADSRImporter(self.db_path, TAG_MAP)
+        cancel_event = threading.Event()
+        progress = []
+
+        def on_progress(event):
+            progress.append(event)
+            cancel_event.set()
+
+        importer.sync_directory(
+            f"{self.root}/Samples",
+            on_progress=on_progress,
+            cancel_event=cancel_event,
+            workers=1,
+        )
+        self.assertEqual(len(progress), 1)
+        self.assertEqual(progress[0]["folders_done"], 1)
+        self.assertEqual(progress[0]["folders_total"], 2)
+        self.assertTrue(os.path.exists(self.xmp_path("Samples")))
+        self.assertFalse(os.path.exists(self.xmp_path("Samples/Kicks")))
+
+    def test_cancel_with_manifest(self, workers=2, io_threads=0):
+        # Folders still in flight when the sync is cancelled get written all
+        # the same, so their tags have to make it into the manifest
+        manifest = SyncManifest(os.path.join(self.root, "manifest.db"))
+        cancel_event = threading.Event()
+        importer = ADSRImporter(self.db_path, TAG_MAP)
+        importer.sync_directory(
+            f"{self.root}/Samples",
+            on_progress=lambda event: cancel_event.set(),
+            cancel_event=cancel_event,
+            workers=workers,
+            manifest=manifest,
+            io_threads=io_threads,
+        )
+        for folder in ("Samples", "Samples/Kicks"):
+            written = manifest.written_tags(f"{self.root}/{folder}")
+            if os.path.exists(self.xmp_path(folder)):
+                xmp = AbletonXMPFile(self.xmp_path(folder))
+                self.assertTrue(written)
+                for file_name, tags in written.items():
+                    self.assertEqual(xmp.get_keywords(file_name), frozenset(tags))
+            else:
+                self.assertFalse(written)
+        manifest.close()
+
+    def test_cancel_with_manifest_and_io_threads(self):
+        self.test_cancel_with_manifest(workers=1, io_threads=2)
+
+    def test_sync(self, workers=1, streaming=False, io_threads=0):
+        importer = ADSRImporter(self.db_path, TAG_MAP)
+        importer.sync_directory(
+            f"{self.root}/Samples",
+            workers=workers,
+            streaming=streaming,
+            io_threads=io_threads,
+        )
+
+        xmp = AbletonXMPFile(self.xmp_path("Samples"))
+        self.assertEqual(
+            xmp.get_keywords("Loop 1.wav"),
+            frozenset(["Drums", "Type|Loop", "Key|A", "Key|Minor"]),
+        )
+        xmp = AbletonXMPFile(self.xmp_path("Samples/Kicks"))
+        self.assertEqual(
+            xmp.get_keywords("Kick 2.wav"),
+            frozenset(["Drums|Kick", "Type|One Shot"]),
+        )
+        self.assertFalse(os.path.exists(self.xmp_path("Other")))
+        self.assertFalse(os.path.exists(self.xmp_path("Samples2")))
+
+        # A second sync has nothing left to add
+        importer = ADSRImporter(self.db_path, TAG_MAP)
+        num_tags_added, _ = importer.sync_directory(
+            f"{self.root}/Samples",
+            workers=workers,
+            streaming=streaming,
+            io_threads=io_threads,
+        )
+        self.assertEqual(num_tags_added, 0)
+
+    def test_sync_with_io_threads(self):
+        self.test_sync(io_threads=2)
+
+    def test_sync_streaming(self):
+        self.test_sync(streaming=True)
+
+    def test_sync_with_process_pool(self):
+        self.test_sync(workers=2)
+
+    def test_plan_and_apply(self, io_threads=0):
+        importer = ADSRImporter(self.db_path, TAG_MAP)
+        plan = importer.plan_directory(
+            f"{self.root}/Samples", workers=1, io_threads=io_threads
+        )
+        self.assertEqual(plan.num_tags, 8)
+        self.assertEqual(plan.unmapped_tags, {"Character|Dark"})
+        self.assertFalse(os.path.exists(self.xmp_path("Samples")))
+
+        num_tags_added, unmapped = importer.sync_directory(
+            f"{self.root}/Samples", workers=1, plan=plan, io_threads=io_threads
+        )
+        self.assertEqual(num_tags_added, 8)
+        self.assertEqual(unmapped, ["Character|Dark"])
+        xmp = AbletonXMPFile(self.xmp_path("Samples/Kicks"))
+        self.assertEqual(
+            xmp.get_keywords("Kick 1.wav"),
+            frozenset(["Drums|Kick", "Type|One Shot"]),
+        )
+
+        # Only tags missing from the sidecars end up in a new plan
+        xmp.add_tags("Kick 1.wav", ["Hand Tagged"])
+        xmp.save_if_changed()
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("INSERT INTO file_tags VALUES (3, 3);")
+        importer = ADSRImporter(self.db_path, TAG_MAP)
+        plan = importer.plan_directory(
+            f"{self.root}/Samples", workers=1, io_threads=io_threads
+        )
+        self.assertEqual(
+            plan.folders,
+            [(f"{self.root}/Samples/Kicks", [("Kick 2.wav", ["Drums|Snare"])])],
+        )
+
+    def test_plan_and_apply_with_io_threads(self):
+        self.test_plan_and_apply(io_threads=2)
+
+    def test_sync_with_manifest(self):
+        manifest = SyncManifest(os.path.join(self.root, "manifest.db"))
+        importer = ADSRImporter(self.db_path, TAG_MAP)
+        num_tags_added, _ = importer.sync_directory(
+            f"{self.root}/Samples", workers=1, manifest=manifest
+        )
+        self.assertEqual(num_tags_added, 8)
+        manifest.close()
+
+        # Nothing changed, so no folder is visited again
+        manifest = SyncManifest(os.path.join(self.root, "manifest.db"))
+        progress = []
+        importer = ADSRImporter(self.db_path, TAG_MAP)
+        importer.sync_directory(
+            f"{self.root}/Samples",
+            workers=1,
+            manifest=manifest,
+            on_progress=progress.append,
+        )
+        self.assertEqual(progress, [])
+
+        # Neither does an empty row for a newly found tag
+        importer = ADSRImporter(self.db_path, dict(TAG_MAP, **{"Brand New": None}))
+        importer.sync_directory(
+            f"{self.root}/Samples",
+            workers=1,
+            manifest=manifest,
+            on_progress=progress.append,
+        )
+        self.assertEqual(progress, [])
+
+        # Losing a sidecar makes that folder sync again
+        os.remove(self.xmp_path("Samples/Kicks"))
+        importer = ADSRImporter(self.db_path, TAG_MAP)
+        num_tags_added, unmapped = importer.sync_directory(
+            f"{self.root}/Samples",
+            workers=1,
+            manifest=manifest,
+            on_progress=progress.append,
+        )
+        self.assertEqual(num_tags_added, 4)
+        self.assertEqual(unmapped, ["Character|Dark"])
+        self.assertEqual(
+            [event["folder"] for event in progress], [f"{self.root}/Samples/Kicks"]
+        )
+        manifest.close()
+
+    def test_reconcile(self):
+        # Drums|Kick was tagged by hand before the first sync
+        xmp = AbletonXMPFile(self.xmp_path("Samples/Kicks"))
+        xmp.add_tags("Kick 1.wav", ["Drums|Kick"])
+        xmp.save_if_changed()
+
+        manifest = SyncManifest(os.path.join(self.root, "manifest.db"))
+        importer = ADSRImporter(self.db_path, TAG_MAP)
+        importer.sync_directory(
+            f"{self.root}/Samples", workers=1, manifest=manifest, reconcile=True
+        )
+        xmp = AbletonXMPFile(self.xmp_path("Samples/Kicks"))
+        xmp.add_tags("Kick 2.wav", ["Hand Tagged"])
+        xmp.save_if_changed()
+
+        # Kicks are remapped and Kick 2 is gone from the database
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("DELETE FROM files WHERE id = 3;")
+        tag_map = dict(TAG_MAP, **{"Drums|Kick": "Percussion|Kick"})
+        importer = ADSRImporter(self.db_path, tag_map)
+        removed = []
+        num_tags_added, _ = importer.sync_directory(
+            f"{self.root}/Samples",
+            workers=1,
+            manifest=manifest,
+            reconcile=True,
+            on_tag_removed=removed.append,
+        )
+        self.assertEqual(num_tags_added, 1)
+        self.assertEqual(importer.last_tags_removed, 2)
+        self.assertEqual(
+            sorted(event["tag"] for event in removed),
+            ["Drums|Kick", "Type|One Shot"],
+        )
+        xmp = AbletonXMPFile(self.xmp_path("Samples/Kicks"))
+        # Tags we didn't add stay
+        self.assertEqual(
+            xmp.get_keywords("Kick 1.wav"),
+            frozenset(["Drums|Kick", "Percussion|Kick", "Type|One Shot"]),
+        )
+        self.assertEqual(xmp.get_keywords("Kick 2.wav"), frozenset(["Hand Tagged"]))
+
+        # Nothing left to do
+        importer = ADSRImporter(self.db_path, tag_map)
+        importer.sync_directory(
+            f"{self.root}/Samples", workers=1, manifest=manifest, reconcile=True
+        )
+        self.assertEqual(importer.last_tags_removed, 0)
+        manifest.close()
+
+        with self.assertRaises(ValueError):
+            importer.sync_directory(f"{self.root}/Samples", reconcile=True)
+
+    def test_reconcile_after_plain_sync(self):
+        # Stale tags left by a sync that didn't reconcile are still removed,
+        # although the manifest sees the folder as unchanged
+        manifest = SyncManifest(os.path.join(self.root, "manifest.db"))
+        for kick, reconcile in (
+            ("Kick A", False),
+            ("Kick B", False),
+            ("Kick B", True),
+        ):
+            tag_map = dict(TAG_MAP, **{"Drums|Kick": kick})
+            importer = ADSRImporter(self.db_path, tag_map)
+            importer.sync_directory(
+                f"{self.root}/Samples",
+                workers=1,
+                manifest=manifest,
+                reconcile=reconcile,
+            )
+        self.assertEqual(importer.last_tags_removed, 2)
+        xmp = AbletonXMPFile(self.xmp_path("Samples/Kicks"))
+        self.assertEqual(
+            xmp.get_keywords("Kick 1.wav"), frozenset(["Kick B", "Type|One Shot"])
+        )
+        manifest.close()
+
+    def test_reuse_importer(self):
+        # One importer can run many syncs and picks up changes to the database
+        with ADSRImporter(self.db_path, TAG_MAP) as importer:
+            num_tags_added, _ = importer.sync_directory(
+                f"{self.root}/Samples", workers=1
+            )
+            self.assertEqual(num_tags_added, 8)
+            num_tags_added, _ = importer.sync_directory(
+                f"{self.root}/Samples", workers=1
+            )
+            self.assertEqual(num_tags_added, 0)
+
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute("INSERT INTO tags VALUES (10, 'Clap', 1, 0);")
+                conn.execute("INSERT INTO file_tags VALUES (3, 10);")
+            num_tags_added, unmapped = importer.sync_directory(
+                f"{self.root}/Samples", workers=1
+            )
+            self.assertEqual(num_tags_added, 0)
+            self.assertIn("Drums|Clap", unmapped)
+
+            # The connection never writes to the ADSR database
+            with self.assertRaises(sqlite3.OperationalError):
+                importer.conn.execute("DELETE FROM tags;")
+        self.assertIsNone(importer.conn)
+
+    def test_concurrent_writer(self):
+        # The Sample Manager committing between two of our reads doesn't leave
+        # the sync with files whose folder it never saw
+        os.makedirs(os.path.join(self.root, "Samples/New"))
+        writer = sqlite3.connect(self.db_path)
+        writer.execute("PRAGMA journal_mode = WAL;")
+        with ADSRImporter(self.db_path, TAG_MAP) as importer:
+            fetch_rows = importer._fetch_rows
+
+            def fetch_rows_and_write(query, params=()):
+                yield from fetch_rows(query, params)
+                if query == importer.FOLDERS_QUERY and not writer.total_changes:
+                    writer.execute(
+                        "INSERT INTO folders VALUES (10, ?);",
+                        (f"{self.root}/Samples/New",),
+                    )
+                    writer.execute("INSERT INTO files VALUES (10, 10, 'New.wav', 0);")
+                    writer.commit()
+
+            importer._fetch_rows = fetch_rows_and_write
+            num_tags_added, _ = importer.sync_directory(
+                f"{self.root}/Samples", workers=1
+            )
+            self.assertEqual(num_tags_added, 8)
+
+            # The next sync sees the new file
+            num_tags_added, _ = importer.sync_directory(
+                f"{self.root}/Samples", workers=1
+            )
+            self.assertEqual(num_tags_added, 1)
+        writer.close()
+
+    def test_appended_folders(self):
+        importer = ADSRImporter(self.db_path, TAG_MAP)
+        checkpoint = importer.table_checkpoint()
+        self.assertIsNone(
+            importer.appended_folders(f"{self.root}/Samples", checkpoint, checkpoint)
+        )
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("INSERT INTO file_tags VALUES (3, 3);")
+            conn.execute("INSERT INTO file_tags VALUES (5, 3);")
+        appended = importer.table_checkpoint()
+        self.assertEqual(
+            importer.appended_folders(f"{self.root}/Samples", checkpoint, appended),
+            {f"{self.root}/Samples/Kicks"},
+        )
+
+        # Deleted rows can't be traced to their folder
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("DELETE FROM file_tags WHERE file_id = 1;")
+        self.assertIsNone(
+            importer.appended_folders(
+                f"{self.root}/Samples", appended, importer.table_checkpoint()
+            )
+        )
+
+    def test_snapshot(self):
+        snapshot_path = os.path.join(self.root, "snapshot.db3")
+        with ADSRImporter(
+            self.db_path, TAG_MAP, snapshot_path=snapshot_path
+        ) as importer:
+            # Writes to the live database don't show up until a new snapshot
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute("INSERT INTO file_tags VALUES (3, 3);")
+            plan = importer.plan_directory(f"{self.root}/Samples", workers=1)
+            self.assertEqual(plan.num_tags, 8)
+
+            importer.refresh_snapshot()
+            plan = importer.plan_directory(f"{self.root}/Samples", workers=1)
+            self.assertEqual(plan.num_tags, 9)
+
+            # The snapshot is indexed so a subfolder sync doesn't scan folders
+            query_plan = importer.conn.execute(
+                "EXPLAIN QUERY PLAN " + importer.FOLDERS_QUERY,
+                folder_range(f"{self.root}/Samples/Kicks/"),
+            ).fetchall()
+            self.assertIn("tag_importer_folders_path", str(query_plan))
+        self.assertTrue(os.path.exists(snapshot_path))
+
+    def test_meta_tags(self):
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("ALTER TABLE sample_meta ADD COLUMN BPM REAL;")
+            conn.executemany(
+                "UPDATE sample_meta SET bpm = ? WHERE id = ?;",
+                [(128, 1), (0, 2), (90, 3)],
+            )
+        importer = ADSRImporter(self.db_path, TAG_MAP, tempo_edges=(90, 120, 140))
+        plan, _ = importer.build_tag_plan(f"{self.root}/Samples")
+        self.assertEqual(
+            plan,
+            [
+                (
+                    f"{self.root}/Samples",
+                    [
+                        (
+                            "Loop 1.wav",
+                            [
+                                "Drums",
+                                "Key|A",
+                                "Key|Minor",
+                                "Tempo|120-140",
+                                "Type|Loop",
+                            ],
+                        )
+                    ],
+                ),
+                (
+                    f"{self.root}/Samples/Kicks",
+                    [
+                        ("Kick 1.wav", ["Drums|Kick", "Type|One Shot"]),
+                        ("Kick 2.wav", ["Drums|Kick", "Tempo|90-120", "Type|One Shot"]),
+                    ],
+                ),
+            ],
+        )
+        # Unknown key codes are counted instead of reported per sample
+        self.assertEqual(importer.unknown_keys, {99: 1})
+
+    def test_meta_tags_coercion(self):
+        # REAL keys and TEXT tempos don't break the sync
+        importer = ADSRImporter(self.db_path, TAG_MAP, tempo_edges=(90, 120, 140))
+        files = [
+            ["Loop 1.wav", 1, [], 30.0, "128"],
+            ["Kick 1.wav", 0, [], "C", "fast"],
+            ["Kick 2.wav", 0, [], None, None],
+        ]
+        self.assertEqual(
+            importer._meta_tags(files),
+            [
+                ["Type|Loop", "Key|A", "Key|Minor", "Tempo|120-140"],
+                ["Type|One Shot"],
+                ["Type|One Shot"],
+            ],
+        )
+        self.assertEqual(importer.unknown_keys, {"C": 1})
+
+    def test_discover_tags(self):
+        importer = ADSRImporter(self.db_path, TAG_MAP)
+        self.assertEqual(
+            importer.discover_tags(f"{self.root}/Samples"),
+            [
+                ("Character|Dark", 2, None),
+                ("Drums|Kick", 2, ("Drums|Kick",)),
+                ("Drums", 1, ("Drums",)),
+            ],
+        )
+        self.assertEqual(
+            importer.discover_tags(f"{self.root}/Samples2"),
+            [("Drums|Kick", 1, ("Drums|Kick",))],
+        )
+
+    def test_folder_range(self):
+        importer = ADSRImporter(self.db_path, TAG_MAP)
+        plan, _ = importer.build_tag_plan(f"{self.root}/Samples/")
+        self.assertEqual(
+            [path for path, _ in plan],
+            [f"{self.root}/Samples", f"{self.root}/Samples/Kicks"],
+        )
+        plan, _ = importer.build_tag_plan(f"{self.root}/Samples/Kicks")
+        self.assertEqual([path for path, _ in plan], [f"{self.root}/Samples/Kicks"])
+
+    def test_some_folders(self):
+        importer = ADSRImporter(self.db_path, TAG_MAP)
+        queries = []
+        importer.conn.set_trace_callback(queries.append)
+        folders = [f"{self.root}/Samples"]
+        plan, _ = importer.build_tag_plan(f"{self.root}/Samples", folders=folders)
+        self.assertEqual(plan, [(f"{self.root}/Samples", [("Loop 1.wav", ANY)])])
+
+        # Many folders are read from the whole prefix in one query per table
+        importer.MAX_FOLDER_QUERIES = 0
+        del queries[:]
+        self.assertEqual(
+            importer.build_tag_plan(f"{self.root}/Samples", folders=folders)[0], plan
+        )
+        self.assertEqual(len([q for q in queries if "SELECT" in q]), 4)
+
+
+class TestTempoBuckets(unittest.TestCase):
+    def test_tempo_buckets(self):
+        self.assertEqual(
+            tempo_buckets([110, 90.5]),
+            ([90.5, 110], ["Tempo|Under 90.5", "Tempo|90.5-110", "Tempo|110+"]),
+        )
+        self.assertEqual(tempo_buckets(()), ([], []))
+
+
+if __name__ == "__main__":
+    unittest.main()
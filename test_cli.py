@@ -0,0 +1,135 @@
+import unittest
+import contextlib
+import io
+import json
+import os
+import threading
+from tempfile import TemporaryDirectory
+
+import cli
+from test_adsrimporter import create_test_db
+
+
+class TestCLI(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.root = self.temp_dir.name
+        for folder in ("Samples/Kicks", "Other"):
+            os.makedirs(os.path.join(self.root, folder))
+        self.db_path = os.path.join(self.root, "adsr.db3")
+        create_test_db(self.db_path, self.root)
+        self.mapping_path = os.path.join(self.root, "data.csv")
+        with open(self.mapping_path, "w", encoding="utf-8") as file:
+            file.write("Drums,Drums\nDrums|Kick,Drums|Kick\nCharacter|Dark,\n")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def run_cli(self, *args):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(
+            io.StringIO()
+        ):
+            self.assertEqual(cli.main(list(args)), 0)
+        return output.getvalue()
+
+    def sync_args(self, *args):
+        return (
+            "sync",
+            "--db",
+            self.db_path,
+            "--dir",
+            f"{self.root}/Samples",
+            "--mapping",
+            self.mapping_path,
+            "--workers",
+            "1",
+            *args,
+        )
+
+    def test_sync_json(self):
+        report = json.loads(self.run_cli(*self.sync_args("--dry-run", "--json")))
+        self.assertEqual(report["tags_added"], 8)
+        self.assertEqual(report["unmapped_tags"], ["Character|Dark"])
+        self.assertEqual(report["folders"], 2)
+        self.assertEqual(len(report["folder_timings"]), 2)
+        self.assertEqual(report["unknown_keys"], {"99": 1})
+
+    def test_sync_profile(self):
+        report = json.loads(self.run_cli(*self.sync_args("--json", "--profile")))
+        phases = report["profile"]["phases"]
+        self.assertEqual(phases["query"]["count"], 1)
+        self.assertEqual(phases["xmp-load"]["count"], 2)
+        self.assertEqual(phases["write"]["count"], 2)
+        self.assertEqual(len(report["profile"]["slowest_folders"]), 2)
+
+    def test_sync_ndjson(self):
+        lines = self.run_cli(*self.sync_args("--ndjson")).splitlines()
+        records = [json.loads(line) for line in lines]
+        self.assertEqual(
+            [record["type"] for record in records], ["folder", "folder", "summary"]
+        )
+        self.assertEqual(sum(record["tags_added"] for record in records[:2]), 8)
+
+    def test_sync_io_threads(self):
+        # --io-threads implies a single process and can't be used with more
+        args = ["--db", self.db_path, "--dir", f"{self.root}/Samples"]
+        args += ["--mapping", self.mapping_path, "--io-threads", "2", "--json"]
+        report = json.loads(self.run_cli("sync", *args))
+        self.assertEqual(report["tags_added"], 8)
+        for extra in (["--workers", "2"], ["--stream"]):
+            with self.assertRaises(SystemExit), contextlib.redirect_stderr(
+                io.StringIO()
+            ):
+                cli.main(["sync", *args, *extra])
+
+    def test_watch(self):
+        args = cli.build_parser().parse_args(["watch", *self.sync_args("--json")[1:]])
+        stop_event = threading.Event()
+        stop_event.set()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(
+            io.StringIO()
+        ):
+            self.assertEqual(cli.run_watch(args, stop_event), 0)
+        # A stopped watcher still does its initial full sync
+        record = json.loads(output.getvalue())
+        self.assertEqual(record["folders"], None)
+        self.assertEqual(record["tags_added"], 8)
+
+    def test_run_job(self):
+        job_path = os.path.join(self.root, "job.json")
+        with open(job_path, "w", encoding="utf-8") as file:
+            json.dump(
+                {"syncs": [{"db": "adsr.db3", "root": "Samples"}]},
+                file,
+            )
+        lines = self.run_cli(
+            "run", "--job", job_path, "--workers", "1", "--json"
+        ).splitlines()
+        records = [json.loads(line) for line in lines]
+        self.assertEqual([record["type"] for record in records], ["sync", "summary"])
+        self.assertEqual(records[0]["root"], f"{self.root}/Samples")
+        self.assertEqual(records[1]["tags_added"], 8)
+
+    def test_discover(self):
+        tags = json.loads(
+            self.run_cli(
+                "discover",
+                "--db",
+                self.db_path,
+                "--dir",
+                f"{self.root}/Samples",
+                "--mapping",
+                self.mapping_path,
+                "--unmapped",
+                "--json",
+            )
+        )
+        self.assertEqual(
+            tags, [{"tag": "Character|Dark", "samples": 2, "destinations": None}]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+import json
+import os
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from abletonxmpfile import AbletonXMPFile
+from adsrimporter import ADSRImporter
+from syncjob import SyncJob, load_job
+from test_adsrimporter import create_test_db
+
+
+class TestSyncJob(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.root = self.temp_dir.name
+        for studio in ("a", "b"):
+            for folder in ("Samples/Kicks", "Other", "Samples2"):
+                os.makedirs(os.path.join(self.root, studio, folder))
+            create_test_db(
+                os.path.join(self.root, f"{studio}.db3"),
+                os.path.join(self.root, studio),
+            )
+        with open(os.path.join(self.root, "data.csv"), "w", encoding="utf-8") as file:
+            file.write("Drums,Drums\nDrums|Kick,Drums|Kick\n")
+        self.job_path = os.path.join(self.root, "job.json")
+        with open(self.job_path, "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    "syncs": [
+                        {"db": "a.db3", "root": "a/Samples"},
+                        # Already covered by the first sync
+                        {"db": "a.db3", "root": "a/Samples/Kicks/"},
+                        {"db": "b.db3", "root": "b/Samples/Kicks"},
+                    ]
+                },
+                file,
+            )
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_load_job(self):
+        entries = load_job(self.job_path)
+        self.assertEqual(
+            entries[1],
+            {
+                "db": f"{self.root}/a.db3",
+                "root": f"{self.root}/a/Samples/Kicks",
+                "mapping": f"{self.root}/data.csv",
+            },
+        )
+
+    def test_run(self):
+        job = SyncJob(load_job(self.job_path), parallel=3)
+        with mock.patch.object(
+            ADSRImporter,
+            "_load_tag_paths",
+            autospec=True,
+            side_effect=ADSRImporter._load_tag_paths,
+        ) as load_tag_paths:
+            results = job.run(workers=1)
+        # The tag tree is resolved once per database
+        self.assertEqual(load_tag_paths.call_count, 2)
+
+        self.assertEqual(
+            [
+                (result["tags_added"], result["folders"], result["folders_skipped"])
+                for result in results
+            ],
+            [(8, 2, 0), (0, 0, 1), (4, 1, 0)],
+        )
+        self.assertEqual(results[0]["unmapped_tags"], ["Character|Dark"])
+
+        xmp = AbletonXMPFile(
+            os.path.join(
+                self.root,
+                "b/Samples/Kicks/Ableton Folder Info",
+                ADSRImporter.XMP_FILENAME,
+            )
+        )
+        self.assertEqual(
+            xmp.get_keywords("Kick 2.wav"), frozenset(["Drums|Kick", "Type|One Shot"])
+        )
+        self.assertFalse(
+            os.path.exists(os.path.join(self.root, "b/Samples/Ableton Folder Info"))
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
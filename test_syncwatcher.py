@@ -0,0 +1,110 @@
+import unittest
+import os
+import sqlite3
+import threading
+from tempfile import TemporaryDirectory
+
+from abletonxmpfile import AbletonXMPFile
+from adsrimporter import ADSRImporter
+from syncwatcher import SyncWatcher
+from test_adsrimporter import TAG_MAP, create_test_db
+
+
+class TestSyncWatcher(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.root = self.temp_dir.name
+        for folder in ("Samples/Kicks", "Other", "Samples2"):
+            os.makedirs(os.path.join(self.root, folder))
+        self.db_path = os.path.join(self.root, "adsr.db3")
+        create_test_db(self.db_path, self.root)
+        self.importer = ADSRImporter(self.db_path, TAG_MAP)
+
+    def tearDown(self):
+        self.importer.close()
+        self.temp_dir.cleanup()
+
+    def kick_keywords(self, file_name):
+        xmp = AbletonXMPFile(
+            os.path.join(
+                self.root,
+                "Samples/Kicks/Ableton Folder Info",
+                ADSRImporter.XMP_FILENAME,
+            )
+        )
+        return xmp.get_keywords(file_name)
+
+    def test_sync_changes(self):
+        watcher = SyncWatcher(self.importer, f"{self.root}/Samples", workers=1)
+        self.assertEqual(watcher.sync_all()["tags_added"], 8)
+        self.assertFalse(watcher.db_changed())
+
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("INSERT INTO file_tags VALUES (3, 3);")
+            conn.execute("INSERT INTO file_tags VALUES (5, 3);")
+        self.assertTrue(watcher.db_changed())
+        self.assertFalse(watcher.db_changed())
+
+        # Only the folder that changed is synced, the sibling is out of scope.
+        # Appended rows lead there without checksumming the whole directory.
+        folder_signatures = self.importer.folder_signatures
+        scopes = []
+
+        def signatures(folder_path, folders=None):
+            scopes.append(folders)
+            return folder_signatures(folder_path, folders)
+
+        self.importer.folder_signatures = signatures
+        result = watcher.sync_changes()
+        self.assertEqual(scopes, [[f"{self.root}/Samples/Kicks"]])
+        self.assertEqual(result["folders"], [f"{self.root}/Samples/Kicks"])
+        self.assertEqual(result["tags_added"], 1)
+        self.assertIn("Drums|Snare", self.kick_keywords("Kick 2.wav"))
+
+        self.assertIsNone(watcher.sync_changes())
+        watcher.close()
+
+    def test_sync_rename(self):
+        # A rename to a name of the same length still changes the checksum
+        watcher = SyncWatcher(self.importer, f"{self.root}/Samples", workers=1)
+        watcher.sync_all()
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("UPDATE files SET name = 'Kick 9.wav' WHERE id = 2;")
+
+        result = watcher.sync_changes()
+        self.assertEqual(result["folders"], [f"{self.root}/Samples/Kicks"])
+        self.assertIn("Drums|Kick", self.kick_keywords("Kick 9.wav"))
+        watcher.close()
+
+    def test_run(self):
+        results = []
+        stop_event = threading.Event()
+
+        def on_sync(result):
+            results.append(result)
+            if len(results) == 1:
+                with sqlite3.connect(self.db_path) as conn:
+                    conn.execute("INSERT INTO file_tags VALUES (3, 3);")
+            else:
+                stop_event.set()
+
+        watcher = SyncWatcher(
+            self.importer,
+            f"{self.root}/Samples",
+            poll_interval=0.01,
+            debounce=0.05,
+            on_sync=on_sync,
+            workers=1,
+        )
+        thread = threading.Thread(target=watcher.run, args=(stop_event,))
+        thread.start()
+        thread.join(timeout=10)
+        self.assertFalse(thread.is_alive())
+        watcher.close()
+
+        self.assertEqual([result["tags_added"] for result in results], [8, 1])
+        self.assertEqual(results[1]["folders"], [f"{self.root}/Samples/Kicks"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+import os
+import stat
+from tempfile import TemporaryDirectory
+
+from tagmapping import MappingTable, TagMapping, load_mapping_csv
+
+
+class TestTagMapping(unittest.TestCase):
+    def setUp(self):
+        self.mapping = TagMapping(
+            {
+                "Drums|*": "Drum Kit|*",
+                "Drums|Kick": "Drums|Kick",
+                "Drums|Kick|*": "Drums|Kick",
+                "Drums|Amen": "-",
+                "Bass": "Bass;Synth|Bass",
+                "Character|Dark": None,
+                "Character|Bright": "",
+            }
+        )
+
+    def test_exact_rule(self):
+        self.assertEqual(self.mapping.lookup("Drums|Kick"), ("Drums|Kick",))
+        self.assertEqual(self.mapping.lookup("Bass"), ("Bass", "Synth|Bass"))
+
+    def test_wildcard_rule(self):
+        self.assertEqual(self.mapping.lookup("Drums|808"), ("Drum Kit|808",))
+        self.assertEqual(
+            self.mapping.lookup("Drums|Snare|Rim"), ("Drum Kit|Snare|Rim",)
+        )
+        # The deepest wildcard wins
+        self.assertEqual(self.mapping.lookup("Drums|Kick|Sub"), ("Drums|Kick",))
+        # A wildcard only matches below its prefix
+        self.assertIsNone(self.mapping.lookup("Drums"))
+
+    def test_drop_rule(self):
+        self.assertEqual(self.mapping.lookup("Drums|Amen"), ())
+
+    def test_unmapped(self):
+        self.assertIsNone(self.mapping.lookup("Character|Dark"))
+        self.assertIsNone(self.mapping.lookup("Character|Bright"))
+        self.assertIsNone(self.mapping.lookup("Vocals"))
+
+
+class TestMappingTable(unittest.TestCase):
+    def test_add_keeps_rows_sorted(self):
+        table = MappingTable([["Drums", None], ["Bass", "Bass"]])
+        self.assertEqual(table.add("Character"), 1)
+        self.assertEqual(table.add("Zither"), 3)
+        self.assertIsNone(table.add("Bass"))
+        self.assertEqual(table.keys, ["Bass", "Character", "Drums", "Zither"])
+        self.assertEqual(table.index("Drums"), 2)
+        self.assertNotIn("Vocals", table)
+
+    def test_csv_round_trip(self):
+        with TemporaryDirectory() as temp_dir:
+            csv_path = os.path.join(temp_dir, "data.csv")
+            table = MappingTable([["Drums|808", "Drum Kit|808"], ["Drums", None]])
+            table.set_value(1, "")
+            table.save_csv(csv_path)
+            self.assertEqual(os.listdir(temp_dir), ["data.csv"])
+            self.assertEqual(
+                load_mapping_csv(csv_path), {"Drums": None, "Drums|808": None}
+            )
+
+    @unittest.skipIf(os.name == "nt", "POSIX file modes")
+    def test_save_keeps_file_mode(self):
+        with TemporaryDirectory() as temp_dir:
+            csv_path = os.path.join(temp_dir, "data.csv")
+            with open(csv_path, "w") as file:
+                file.write("Drums,Drums\n")
+            os.chmod(csv_path, 0o664)
+            MappingTable([["Drums", "Drum Kit"]]).save_csv(csv_path)
+            self.assertEqual(stat.S_IMODE(os.stat(csv_path).st_mode), 0o664)
+
+
+if __name__ == "__main__":
+    unittest.main()
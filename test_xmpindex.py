@@ -0,0 +1,86 @@
+import unittest
+import os
+from tempfile import TemporaryDirectory
+
+from abletonxmpfile import AbletonXMPFile
+from xmpindex import XMPIndex
+
+
+class TestXMPIndex(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.root = self.temp_dir.name
+        self.index = XMPIndex(os.path.join(self.root, "index.db"))
+
+    def tearDown(self):
+        self.index.close()
+        self.temp_dir.cleanup()
+
+    def write_sidecar(self, folder, file_tags):
+        xmp_path = os.path.join(
+            self.root, "Samples", folder, "Ableton Folder Info", "index.xmp"
+        )
+        xmp = AbletonXMPFile(xmp_path)
+        for file_name, tags in file_tags.items():
+            xmp.add_tags(file_name, tags)
+        xmp.save_if_changed()
+        return xmp_path
+
+    def test_update_and_query(self, workers=1):
+        self.write_sidecar("Kicks", {"Kick 1.wav": ["Drums|Kick", "Type|One Shot"]})
+        self.write_sidecar("Loops", {"Loop 1.wav": ["Type|Loop", "Drums|Kick"]})
+
+        counts = self.index.update(f"{self.root}/Samples", workers=workers)
+        self.assertEqual(counts, {"found": 2, "indexed": 2, "removed": 0})
+        self.assertEqual(
+            self.index.files_with_tag("Drums|Kick"),
+            [
+                f"{self.root}/Samples/Kicks/Kick 1.wav",
+                f"{self.root}/Samples/Loops/Loop 1.wav",
+            ],
+        )
+        self.assertEqual(self.index.tag_histogram()[0], ("Drums|Kick", 2))
+
+    def test_update_with_process_pool(self):
+        self.test_update_and_query(workers=2)
+
+    def test_incremental_update(self):
+        self.write_sidecar("Kicks", {"Kick 1.wav": ["Drums|Kick"]})
+        loops_path = self.write_sidecar("Loops", {"Loop 1.wav": ["Type|Loop"]})
+        self.index.update(f"{self.root}/Samples", workers=1)
+
+        # Unchanged sidecars are not read again
+        counts = self.index.update(f"{self.root}/Samples", workers=1)
+        self.assertEqual(counts, {"found": 2, "indexed": 0, "removed": 0})
+
+        self.write_sidecar("Kicks", {"Kick 2.wav": ["Drums|Kick"]})
+        os.remove(loops_path)
+        counts = self.index.update(f"{self.root}/Samples", workers=1)
+        self.assertEqual(counts, {"found": 1, "indexed": 1, "removed": 1})
+        self.assertEqual(
+            self.index.keywords_for_folder(f"{self.root}/Samples/Kicks"),
+            {"Kick 1.wav": {"Drums|Kick"}, "Kick 2.wav": {"Drums|Kick"}},
+        )
+        self.assertEqual(self.index.files_with_tag("Type|Loop"), [])
+
+    def test_relative_root(self):
+        # A relative root indexes the same keys as the absolute one
+        self.write_sidecar("Kicks", {"Kick 1.wav": ["Drums|Kick"]})
+        cwd = os.getcwd()
+        os.chdir(self.root)
+        try:
+            counts = self.index.update("Samples", workers=1)
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(counts, {"found": 1, "indexed": 1, "removed": 0})
+
+        counts = self.index.update(f"{self.root}/Samples/", workers=1)
+        self.assertEqual(counts, {"found": 1, "indexed": 0, "removed": 0})
+        self.assertEqual(
+            self.index.files_with_tag("Drums|Kick"),
+            [f"{self.root}/Samples/Kicks/Kick 1.wav"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,162 @@
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+from abletonxmpfile import read_keywords
+
+FOLDER_INFO_DIR = "Ableton Folder Info"
+
+
+def find_sidecars(library_root):
+    # Yields the path of every Ableton sidecar below library_root
+    for dir_path, dir_names, file_names in os.walk(library_root):
+        if os.path.basename(dir_path) == FOLDER_INFO_DIR:
+            dir_names[:] = []
+            for file_name in file_names:
+                if file_name.endswith(".xmp"):
+                    yield os.path.join(dir_path, file_name)
+
+
+class XMPIndex:
+    # A local SQLite index of the keywords Ableton has in its sidecars, so
+    # tags can be queried without parsing every XMP file again. Updates only
+    # re-read sidecars whose mtime or size changed.
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.conn = sqlite3.connect(index_path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sidecars (
+                id INTEGER PRIMARY KEY,
+                path TEXT NOT NULL UNIQUE,
+                folder TEXT NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS keywords (
+                sidecar_id INTEGER NOT NULL REFERENCES sidecars(id),
+                file_name TEXT NOT NULL,
+                keyword TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS keywords_keyword ON keywords(keyword);
+            CREATE INDEX IF NOT EXISTS keywords_sidecar_file
+                ON keywords(sidecar_id, file_name);
+            CREATE INDEX IF NOT EXISTS sidecars_folder ON sidecars(folder);
+            """)
+
+    def update(self, library_root, workers=None):
+        # Scans library_root and brings the index up to date, returns counts
+        # of the sidecars found, (re)indexed and removed
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        # Paths are stored absolute, so the same library is indexed under the
+        # same keys whatever the working directory or spelling of the root
+        library_root = os.path.abspath(library_root)
+        prefix = library_root.rstrip("/")
+        indexed = {
+            path: (sidecar_id, mtime_ns, size)
+            for sidecar_id, path, mtime_ns, size in self.conn.execute(
+                "SELECT id,path,mtime_ns,size FROM sidecars "
+                "WHERE path >= ? AND path < ?;",
+                (f"{prefix}/", f"{prefix}0"),
+            )
+        }
+
+        found = 0
+        changed = []
+        for path in find_sidecars(library_root):
+            found += 1
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entry = indexed.pop(path, None)
+            if entry is None or entry[1:] != (stat.st_mtime_ns, stat.st_size):
+                changed.append((path, stat.st_mtime_ns, stat.st_size))
+
+        # Whatever is left in indexed no longer exists on disk
+        removed = [(sidecar_id,) for sidecar_id, _, _ in indexed.values()]
+
+        if workers > 1 and len(changed) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                keywords = executor.map(
+                    read_keywords,
+                    [path for path, _, _ in changed],
+                    chunksize=max(1, len(changed) // (workers * 4)),
+                )
+                self._store(changed, keywords, removed)
+        else:
+            keywords = (read_keywords(path) for path, _, _ in changed)
+            self._store(changed, keywords, removed)
+
+        return {"found": found, "indexed": len(changed), "removed": len(removed)}
+
+    def _store(self, changed, keywords, removed):
+        with self.conn:
+            self.conn.executemany("DELETE FROM keywords WHERE sidecar_id = ?;", removed)
+            self.conn.executemany("DELETE FROM sidecars WHERE id = ?;", removed)
+            for (path, mtime_ns, size), file_keywords in zip(changed, keywords):
+                folder = os.path.dirname(os.path.dirname(path))
+                self.conn.execute(
+                    """
+                    INSERT INTO sidecars (path,folder,mtime_ns,size)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(path) DO UPDATE SET
+                        mtime_ns = excluded.mtime_ns, size = excluded.size;
+                    """,
+                    (path, folder, mtime_ns, size),
+                )
+                (sidecar_id,) = self.conn.execute(
+                    "SELECT id FROM sidecars WHERE path = ?;", (path,)
+                ).fetchone()
+                self.conn.execute(
+                    "DELETE FROM keywords WHERE sidecar_id = ?;", (sidecar_id,)
+                )
+                self.conn.executemany(
+                    "INSERT INTO keywords VALUES (?, ?, ?);",
+                    (
+                        (sidecar_id, file_name, keyword)
+                        for file_name, file_keywords in file_keywords.items()
+                        for keyword in file_keywords
+                    ),
+                )
+
+    def files_with_tag(self, keyword):
+        # Returns the full paths of all samples carrying keyword
+        return [
+            f"{folder}/{file_name}"
+            for folder, file_name in self.conn.execute(
+                """
+                SELECT sidecars.folder,keywords.file_name FROM keywords
+                JOIN sidecars ON sidecars.id = keywords.sidecar_id
+                WHERE keywords.keyword = ?
+                ORDER BY sidecars.folder,keywords.file_name;
+                """,
+                (keyword,),
+            )
+        ]
+
+    def keywords_for_folder(self, folder):
+        folder = os.path.abspath(folder)
+        keywords = {}
+        for file_name, keyword in self.conn.execute(
+            """
+            SELECT keywords.file_name,keywords.keyword FROM keywords
+            JOIN sidecars ON sidecars.id = keywords.sidecar_id
+            WHERE sidecars.folder = ?;
+            """,
+            (folder,),
+        ):
+            keywords.setdefault(file_name, set()).add(keyword)
+        return keywords
+
+    def tag_histogram(self):
+        # [(keyword, number of samples)], most used first
+        return self.conn.execute("""
+            SELECT keyword,COUNT(*) AS samples FROM keywords
+            GROUP BY keyword ORDER BY samples DESC,keyword;
+            """).fetchall()
+
+    def close(self):
+        self.conn.close()